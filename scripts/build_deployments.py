@@ -1,7 +1,10 @@
-import csv
+import re
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
 
+import pandas as pd
+
 REPO = Path(__file__).resolve().parents[1]
 RAW  = REPO / "datapackage" / "raw_deployment.csv"
 OUT  = REPO / "datapackage" / "deployments.csv"
@@ -14,45 +17,61 @@ TZ_ABBR_TO_OFFSET = {
     "PST": "-08:00", "PDT": "-07:00",
 }
 
+_OFFSET_RE = re.compile(r"[+-]\d{2}:\d{2}")  # e.g. -05:00
+
+# strptime formats in the order they're tried; the last one that matched is
+# moved to the front, since a sheet almost always uses one format throughout
+DATE_FORMATS = ["%m/%d/%Y", "%m/%d/%y", "%Y-%m-%d"]
+TIME_FORMATS = ["%I:%M:%S %p", "%I:%M %p", "%H:%M:%S", "%H:%M"]
+
+@lru_cache(maxsize=None)
 def normalize_offset(val: str | None, header_hint: str | None, default_hint: str = "EST") -> str:
     if val and val.strip():
         v = val.strip().upper()
-        if v == "Z": return "Z"
-        if len(v) == 6 and v[0] in "+-" and v[1:3].isdigit() and v[3] == ":" and v[4:6].isdigit():
+        if v == "Z" or _OFFSET_RE.fullmatch(v):
             return v
-        if v in TZ_ABBR_TO_OFFSET:
-            return TZ_ABBR_TO_OFFSET[v]
-        return v
+        return TZ_ABBR_TO_OFFSET.get(v, v)
     if header_hint:
-        h = header_hint.strip().upper()
-        if h in TZ_ABBR_TO_OFFSET:
-            return TZ_ABBR_TO_OFFSET[h]
+        h = TZ_ABBR_TO_OFFSET.get(header_hint.strip().upper())
+        if h:
+            return h
     h = default_hint.strip().upper()
     return TZ_ABBR_TO_OFFSET.get(h, "Z")
 
-def parse_date(s: str | None) -> datetime | None:
-    if not s or not s.strip():
-        return None
-    s = s.strip()
-    for fmt in ("%m/%d/%Y", "%m/%d/%y", "%Y-%m-%d"):
+def _strptime_any(s: str, formats: list[str]) -> datetime | None:
+    for i, fmt in enumerate(formats):
         try:
             d = datetime.strptime(s, fmt)
-            return datetime(d.year, d.month, d.day, 0, 0, 0)
         except ValueError:
-            pass
-    raise ValueError(f"Unrecognized date format: {s}")
+            continue
+        if i:
+            formats.insert(0, formats.pop(i))
+        return d
+    return None
+
+@lru_cache(maxsize=None)
+def _parse_date_cached(s: str) -> datetime:
+    d = _strptime_any(s, DATE_FORMATS)
+    if d is None:
+        raise ValueError(f"Unrecognized date format: {s}")
+    return datetime(d.year, d.month, d.day, 0, 0, 0)
+
+@lru_cache(maxsize=None)
+def _parse_time_cached(s: str):
+    t = _strptime_any(s, TIME_FORMATS)
+    if t is None:
+        raise ValueError(f"Unrecognized time format: {s}")
+    return (t.hour, t.minute, getattr(t, "second", 0))
+
+def parse_date(s: str | None) -> datetime | None:
+    if not s or not s.strip():
+        return None
+    return _parse_date_cached(s.strip())
 
 def parse_time(s: str | None):
     if not s or not s.strip():
         return None
-    s = s.strip()
-    for fmt in ("%I:%M:%S %p", "%I:%M %p", "%H:%M:%S", "%H:%M"):
-        try:
-            t = datetime.strptime(s, fmt)
-            return (t.hour, t.minute, getattr(t, "second", 0))
-        except ValueError:
-            pass
-    raise ValueError(f"Unrecognized time format: {s}")
+    return _parse_time_cached(s.strip())
 
 def combine_dt(d: datetime | None, hms, end_of_day_if_none=False):
     if d is None:
@@ -65,8 +84,9 @@ def combine_dt(d: datetime | None, hms, end_of_day_if_none=False):
 def iso_with_offset(dt: datetime | None, offset: str) -> str:
     if dt is None:
         return ""
-    base = dt.strftime("%Y-%m-%dT%H:%M:%S")
-    return base + ("Z" if offset == "Z" else offset)
+    # fixed layout, so format directly rather than through strftime
+    return (f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+            f"T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}{offset}")
 
 def normalize_bool(val: str | None) -> str:
     if val is None: return ""
@@ -82,8 +102,18 @@ def normalize_camera_model(m: str | None) -> str:
         return f"Reconyx-{m}"
     return m
 
-def safe_num(s: str | None) -> str:
-    return s.strip() if s and s.strip() else ""
+def map_unique(col: pd.Series, fn) -> list:
+    """Apply fn once per distinct value of col and broadcast the results back
+    to every row (the raw sheet repeats the same dates/times/models a lot)."""
+    lookup = {v: fn(v) for v in col.unique()}
+    return [lookup[v] for v in col]
+
+OUT_FIELDS = [
+    "deploymentID","locationID","locationName","latitude","longitude","coordinateUncertainty",
+    "deploymentStart","deploymentEnd","setupBy","cameraID","cameraModel",
+    "cameraDelay","cameraHeight","cameraDepth","cameraTilt","cameraHeading","detectionDistance",
+    "timestampIssues","baitUse","featureType","habitat","deploymentGroups","deploymentTags","deploymentComments",
+]
 
 def main():
     print(f"[INFO] RAW : {RAW}")
@@ -94,115 +124,91 @@ def main():
 
     OUT.parent.mkdir(parents=True, exist_ok=True)
 
-    with RAW.open("r", encoding="utf-8-sig") as f_in, OUT.open("w", newline="", encoding="utf-8") as f_out:
-        r = csv.DictReader(f_in)
-        if not r.fieldnames:
-            print("[ERROR] No header row found in RAW.")
-            return
-
-        # detect an 'EndTime ...' header and pull TZ hint (e.g., 'EndTime EST')
-        end_time_header = None
-        tz_hint_from_header = None
-        for h in r.fieldnames:
-            if h and "endtime" in h.replace(" ", "").lower():
-                end_time_header = h
-                parts = h.split()
-                if len(parts) >= 2:
-                    tz_hint_from_header = parts[-1]
-                break
-
-        print("[INFO] Headers:", r.fieldnames)
-        print("[INFO] EndTime header:", end_time_header, "TZ hint:", tz_hint_from_header)
-
-        w = csv.DictWriter(
-            f_out,
-            fieldnames=[
-                "deploymentID","locationID","locationName","latitude","longitude","coordinateUncertainty",
-                "deploymentStart","deploymentEnd","setupBy","cameraID","cameraModel",
-                "cameraDelay","cameraHeight","cameraDepth","cameraTilt","cameraHeading","detectionDistance",
-                "timestampIssues","baitUse","featureType","habitat","deploymentGroups","deploymentTags","deploymentComments",
-            ],
-        )
-        w.writeheader()
-
-        written = 0
-        for i, row in enumerate(r, start=1):
-            # skip fully blank lines
-            if not any((row.get(k) or "").strip() for k in r.fieldnames):
-                continue
-
-            siteID   = (row.get("siteID") or "").strip()
-            serial   = (row.get("cameraSerial") or "").strip()
-            model    = normalize_camera_model(row.get("cameraModel"))
-            lat      = (row.get("latitude") or "").strip()
-            lon      = (row.get("longitude") or "").strip()
-
-            start_d  = parse_date(row.get("startLocal"))
-            end_d    = parse_date(row.get("endLocal"))
-            start_t  = parse_time(row.get("StartTime"))
-            end_t    = parse_time(row.get(end_time_header)) if end_time_header else None
-
-            offset   = normalize_offset(row.get("offset"), tz_hint_from_header, default_hint="EST")
-
-            start_dt = combine_dt(start_d, start_t, end_of_day_if_none=False)
-            end_dt   = combine_dt(end_d,   end_t,   end_of_day_if_none=True)
-
-            start_iso = iso_with_offset(start_dt, offset)
-            end_iso   = iso_with_offset(end_dt, offset)
-
-            deploymentID = f"{siteID}_{serial}".strip("_")
-            locationID   = (row.get("locationID") or siteID).strip()
-            locationName = (row.get("locationName") or "").strip()
-            setupBy      = (row.get("setUp") or "").strip()
-
-            coord_unc    = safe_num(row.get("coordinateUncertainty"))
-            cam_delay    = safe_num(row.get("cameraDelay"))
-            cam_height   = safe_num(row.get("cameraHeight"))
-            cam_depth    = safe_num(row.get("cameraDepth"))
-            cam_tilt     = safe_num(row.get("cameraTilt"))
-            cam_heading  = safe_num(row.get("cameraHeading"))
-            detect_dist  = safe_num(row.get("detectionDistance"))
-            ts_issues    = normalize_bool(row.get("timestampIssues"))
-            bait_use     = normalize_bool(row.get("baitUse"))
-            feature      = (row.get("featureType") or "").strip()
-            habitat      = (row.get("habitat") or "").strip()
-            groups       = (row.get("deploymentGroups") or "").strip()
-            tags         = (row.get("deploymentTags") or "").strip()
-            comments     = (row.get("comments") or "").strip()
-
-            if i == 1:
-                print("[INFO] Example first row →",
-                      {"deploymentID": deploymentID, "start": start_iso, "end": end_iso, "cameraID": serial})
-
-            w.writerow({
-                "deploymentID": deploymentID,
-                "locationID": locationID,
-                "locationName": locationName,
-                "latitude": lat,
-                "longitude": lon,
-                "coordinateUncertainty": coord_unc,
-                "deploymentStart": start_iso,
-                "deploymentEnd": end_iso,
-                "setupBy": setupBy,
-                "cameraID": serial,
-                "cameraModel": model,
-                "cameraDelay": cam_delay,
-                "cameraHeight": cam_height,
-                "cameraDepth": cam_depth,
-                "cameraTilt": cam_tilt,
-                "cameraHeading": cam_heading,
-                "detectionDistance": detect_dist,
-                "timestampIssues": ts_issues,
-                "baitUse": bait_use,
-                "featureType": feature,
-                "habitat": habitat,
-                "deploymentGroups": groups,
-                "deploymentTags": tags,
-                "deploymentComments": comments,
-            })
-            written += 1
-
-    print(f" Wrote {OUT} ({written} rows)")
+    try:
+        # everything as text; index_col=False keeps trailing commas from shifting columns
+        df = pd.read_csv(RAW, dtype=str, keep_default_na=False, encoding="utf-8-sig", index_col=False)
+    except pd.errors.EmptyDataError:
+        print("[ERROR] No header row found in RAW.")
+        return
+    headers = list(df.columns)
+
+    # detect an 'EndTime ...' header and pull TZ hint (e.g., 'EndTime EST')
+    end_time_header = None
+    tz_hint_from_header = None
+    for h in headers:
+        if h and "endtime" in h.replace(" ", "").lower():
+            end_time_header = h
+            parts = h.split()
+            if len(parts) >= 2:
+                tz_hint_from_header = parts[-1]
+            break
+
+    print("[INFO] Headers:", headers)
+    print("[INFO] EndTime header:", end_time_header, "TZ hint:", tz_hint_from_header)
+
+    # strip every cell once, then skip fully blank lines
+    df = df.fillna("").apply(lambda c: c.str.strip())
+    df = df[(df != "").any(axis=1)]
+
+    def col(name: str | None) -> pd.Series:
+        if name in df.columns:
+            return df[name]
+        return pd.Series("", index=df.index)
+
+    siteID = col("siteID")
+    serial = col("cameraSerial")
+
+    start_d = map_unique(col("startLocal"), parse_date)
+    end_d   = map_unique(col("endLocal"), parse_date)
+    start_t = map_unique(col("StartTime"), parse_time)
+    end_t   = map_unique(col(end_time_header), parse_time)
+
+    offset  = map_unique(col("offset"), lambda v: normalize_offset(v, tz_hint_from_header, default_hint="EST"))
+
+    start_iso = [iso_with_offset(combine_dt(d, t, end_of_day_if_none=False), o)
+                 for d, t, o in zip(start_d, start_t, offset)]
+    end_iso   = [iso_with_offset(combine_dt(d, t, end_of_day_if_none=True), o)
+                 for d, t, o in zip(end_d, end_t, offset)]
+
+    location_id = col("locationID")
+
+    out = pd.DataFrame({
+        "deploymentID": (siteID + "_" + serial).str.strip("_"),
+        "locationID": location_id.where(location_id != "", siteID),
+        "locationName": col("locationName"),
+        "latitude": col("latitude"),
+        "longitude": col("longitude"),
+        "coordinateUncertainty": col("coordinateUncertainty"),
+        "deploymentStart": start_iso,
+        "deploymentEnd": end_iso,
+        "setupBy": col("setUp"),
+        "cameraID": serial,
+        "cameraModel": map_unique(col("cameraModel"), normalize_camera_model),
+        "cameraDelay": col("cameraDelay"),
+        "cameraHeight": col("cameraHeight"),
+        "cameraDepth": col("cameraDepth"),
+        "cameraTilt": col("cameraTilt"),
+        "cameraHeading": col("cameraHeading"),
+        "detectionDistance": col("detectionDistance"),
+        "timestampIssues": map_unique(col("timestampIssues"), normalize_bool),
+        "baitUse": map_unique(col("baitUse"), normalize_bool),
+        "featureType": col("featureType"),
+        "habitat": col("habitat"),
+        "deploymentGroups": col("deploymentGroups"),
+        "deploymentTags": col("deploymentTags"),
+        "deploymentComments": col("comments"),
+    }, columns=OUT_FIELDS)
+
+    if len(out):
+        first = out.iloc[0]
+        print("[INFO] Example first row →",
+              {"deploymentID": first["deploymentID"], "start": first["deploymentStart"],
+               "end": first["deploymentEnd"], "cameraID": first["cameraID"]})
+
+    # same CRLF line endings the csv module writes
+    out.to_csv(OUT, index=False, encoding="utf-8", lineterminator="\r\n")
+
+    print(f" Wrote {OUT} ({len(out)} rows)")
 
 if __name__ == "__main__":
     main()
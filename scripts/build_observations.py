@@ -1,30 +1,47 @@
 import csv
-import json
+from hashlib import blake2b
 from pathlib import Path
-import uuid
 import argparse
 
-
+from csvio import load_json
 
 REPO = Path(__file__).resolve().parents[1]
 MEDIA = REPO / "datapackage" / "media.csv"
 OUT   = REPO / "datapackage" / "observations.csv"
 
-def exif_to_event_id(row):
+OBS_FIELDS = [
+    "observationID","deploymentID","mediaID","eventID",
+    "eventStart","eventEnd",
+    "observationLevel","observationType","cameraSetupType",
+    "scientificName","count","lifeStage","sex","behavior",
+    "individualID","individualPositionRadius","individualPositionAngle","individualSpeed",
+    "bboxX","bboxY","bboxWidth","bboxHeight",
+    "classificationMethod","classifiedBy","classificationTimestamp","classificationProbability",
+    "observationTags","observationComments"
+]
+TEMPLATE_FIELDS = [
+    "observationID","mediaID","filePath","timestamp",
+    "observationType","scientificName","count","lifeStage","sex","behavior","observationComments",
+]
+WRITE_BUFFER = 1 << 20  # 1 MiB output buffers
+
+def exif_to_event_id(exif_str: str, dep: str) -> str:
     """
     Try to derive a stable eventID from EXIF:
     - Prefer 'EventNumber' (Reconyx)
     - Else derive from 'Sequence' like '1 of 3' -> '1'
+    Takes the (stripped) exifData and deploymentID cells of a media row.
     Returns string like '<deploymentID>_ev<NNN>' or '' if not available.
     """
-    exif_str = (row.get("exifData") or "").strip()
     if not exif_str:
         return ""
+    # cheap probe first: most rows carry neither key, so skip the JSON parse
+    if "EventNumber" not in exif_str and "Sequence" not in exif_str:
+        return ""
     try:
-        exif = json.loads(exif_str)
+        exif = load_json(exif_str)
     except Exception:
         return ""
-    dep = (row.get("deploymentID") or "").strip()
     if not dep:
         return ""
     # Reconyx often has both:
@@ -38,6 +55,10 @@ def exif_to_event_id(row):
             return f"{dep}_ev{first}"
     return ""
 
+def cell(row: list[str], i: int | None) -> str:
+    """Stripped value of column i, or '' if the column is absent or the row is short."""
+    return row[i].strip() if i is not None and i < len(row) else ""
+
 def main():
     parser = argparse.ArgumentParser(description="Build Camtrap DP observations.csv from media.csv")
     parser.add_argument(
@@ -65,109 +86,107 @@ def main():
         return
 
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmpl_path = out_path.parent / "observations_to_label.csv"
+
+    # Stream rows straight to observations.csv (and the label template, which
+    # is only opened once there's a row for it) instead of buffering them
+    n_obs = 0
+    tf = tw = None
+    try:
+        with media_path.open("r", encoding="utf-8") as fin, \
+             out_path.open("w", newline="", encoding="utf-8", buffering=WRITE_BUFFER) as fout:
+            # plain reader + header index: no per-row dict, fields looked up by position
+            r = csv.reader(fin)
+            idx = {name: i for i, name in enumerate(next(r, []))}
+            i_media, i_dep, i_ts = idx.get("mediaID"), idx.get("deploymentID"), idx.get("timestamp")
+            i_path, i_exif = idx.get("filePath"), idx.get("exifData")
+
+            w = csv.DictWriter(fout, fieldnames=OBS_FIELDS)
+            w.writeheader()
+            for row in r:
+                # skip totally blank lines
+                if not any(f.strip() for f in row):
+                    continue
+
+                media_id = cell(row, i_media)
+                dep_id   = cell(row, i_dep)
+                ts       = cell(row, i_ts)
+                filePath = cell(row, i_path)  # helpful context in the template
+
+                if not media_id or not dep_id or not ts:
+                    # skip rows missing the essentials
+                    continue
+
+                # Deterministic 8-hex ID: no syscall per row, and re-running on the
+                # same media.csv keeps IDs stable so existing label files still match
+                obs_id = blake2b(f"{dep_id}|{media_id}|{ts}".encode(), digest_size=4).hexdigest()
+
+                # Optional eventID from EXIF (if available)
+                event_id = exif_to_event_id(cell(row, i_exif), dep_id)
+
+                w.writerow({
+                    "observationID": obs_id,
+                    "deploymentID": dep_id,
+                    "mediaID": media_id,
+                    "eventID": event_id,
+                    "eventStart": ts,
+                    "eventEnd": ts,
+                    "observationLevel": "media",
+                    "observationType": "unclassified",
+                    "cameraSetupType": "",
+
+                    "scientificName": "",
+                    "count": "",
+                    "lifeStage": "",
+                    "sex": "",
+                    "behavior": "",
+                    "individualID": "",
+                    "individualPositionRadius": "",
+                    "individualPositionAngle": "",
+                    "individualSpeed": "",
+                    "bboxX": "",
+                    "bboxY": "",
+                    "bboxWidth": "",
+                    "bboxHeight": "",
+
+                    "classificationMethod": "",
+                    "classifiedBy": "",
+                    "classificationTimestamp": "",
+                    "classificationProbability": "",
+                    "observationTags": "",
+                    "observationComments": "",
+                })
+                n_obs += 1
+
+                if not args.emit_label_template:
+                    continue
+                if tw is None:
+                    tf = tmpl_path.open("w", newline="", encoding="utf-8", buffering=WRITE_BUFFER)
+                    tw = csv.DictWriter(tf, fieldnames=TEMPLATE_FIELDS)
+                    tw.writeheader()
+                # Minimal human-editable template row (context + editable fields)
+                tw.writerow({
+                    "observationID": obs_id,
+                    "mediaID":       media_id,
+                    "filePath":      filePath,
+                    "timestamp":     ts,
+                    # Editable fields:
+                    "observationType": "unclassified",  # animal|human|vehicle|blank|unknown|unclassified
+                    "scientificName": "",
+                    "count": "",
+                    "lifeStage": "",     # adult|subadult|juvenile
+                    "sex": "",           # female|male
+                    "behavior": "",
+                    "observationComments": "",
+                })
+    finally:
+        if tf is not None:
+            tf.close()
+
+    print(f" Wrote {out_path} ({n_obs} observations)")
 
-    # Collect rows so we can write observations.csv and the label template
-    obs_rows = []
-    tmpl_rows = []
-
-    with media_path.open("r", encoding="utf-8") as fin:
-        r = csv.DictReader(fin)
-        n_in = 0
-        for row in r:
-            # skip totally blank lines
-            if not any((row.get(k) or "").strip() for k in (r.fieldnames or [])):
-                continue
-            n_in += 1
-
-            media_id = (row.get("mediaID") or "").strip()
-            dep_id   = (row.get("deploymentID") or "").strip()
-            ts       = (row.get("timestamp") or "").strip()
-            filePath = (row.get("filePath") or "").strip()  # helpful context in the template
-
-            if not media_id or not dep_id or not ts:
-                # skip rows missing the essentials
-                continue
-
-            # Deterministic or random chose UUID earlier; keep that:
-            obs_id = uuid.uuid4().hex[:8]
-
-            # Optional eventID from EXIF (if available)
-            event_id = exif_to_event_id(row)
-
-            obs_rows.append({
-                "observationID": obs_id,
-                "deploymentID": dep_id,
-                "mediaID": media_id,
-                "eventID": event_id,
-                "eventStart": ts,
-                "eventEnd": ts,
-                "observationLevel": "media",
-                "observationType": "unclassified",
-                "cameraSetupType": "",
-
-                "scientificName": "",
-                "count": "",
-                "lifeStage": "",
-                "sex": "",
-                "behavior": "",
-                "individualID": "",
-                "individualPositionRadius": "",
-                "individualPositionAngle": "",
-                "individualSpeed": "",
-                "bboxX": "",
-                "bboxY": "",
-                "bboxWidth": "",
-                "bboxHeight": "",
-
-                "classificationMethod": "",
-                "classifiedBy": "",
-                "classificationTimestamp": "",
-                "classificationProbability": "",
-                "observationTags": "",
-                "observationComments": "",
-            })
-
-            # Minimal human-editable template row (context + editable fields)
-            tmpl_rows.append({
-                "observationID": obs_id,
-                "mediaID":       media_id,
-                "filePath":      filePath,
-                "timestamp":     ts,
-                # Editable fields:
-                "observationType": "unclassified",  # animal|human|vehicle|blank|unknown|unclassified
-                "scientificName": "",
-                "count": "",
-                "lifeStage": "",     # adult|subadult|juvenile
-                "sex": "",           # female|male
-                "behavior": "",
-                "observationComments": "",
-            })
-
-    # Write observations.csv
-    with out_path.open("w", newline="", encoding="utf-8") as fout:
-        w = csv.DictWriter(fout, fieldnames=[
-            "observationID","deploymentID","mediaID","eventID",
-            "eventStart","eventEnd",
-            "observationLevel","observationType","cameraSetupType",
-            "scientificName","count","lifeStage","sex","behavior",
-            "individualID","individualPositionRadius","individualPositionAngle","individualSpeed",
-            "bboxX","bboxY","bboxWidth","bboxHeight",
-            "classificationMethod","classifiedBy","classificationTimestamp","classificationProbability",
-            "observationTags","observationComments"
-        ])
-        w.writeheader()
-        w.writerows(obs_rows)
-
-    print(f" Wrote {out_path} ({len(obs_rows)} observations)")
-
-    # 2) Optionally write the label template
     if args.emit_label_template:
-        tmpl_path = out_path.parent / "observations_to_label.csv"
-        if tmpl_rows:
-            with tmpl_path.open("w", newline="", encoding="utf-8") as tf:
-                tw = csv.DictWriter(tf, fieldnames=list(tmpl_rows[0].keys()))
-                tw.writeheader()
-                tw.writerows(tmpl_rows)
+        if tw is not None:
             print(f" Label template → {tmpl_path}")
         else:
             print("[WARN] No rows available to create observations_to_label.csv")
@@ -0,0 +1,53 @@
+# scripts/csvio.py
+"""
+JSON and CSV readers shared by the pipeline scripts (they are run as
+`python scripts/x.py`, which puts this folder on sys.path).
+"""
+import csv
+import json
+
+try:
+    import orjson  # optional: C JSON parser/serializer, several times faster than json
+except ImportError:
+    orjson = None
+
+def load_json(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN or big integers: let json parse it or raise the usual error
+    return json.loads(text)
+
+def dump_json(obj) -> str:
+    """Compact JSON text (UTF-8, no ASCII escaping), via orjson when installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except orjson.JSONEncodeError:
+            pass  # e.g. integers beyond 64 bits, which json handles
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def load_frame(path):
+    """Whole CSV as text: no NaN/type inference, short rows padded with ''."""
+    # imported here, so extract_exif (JSON helpers only) doesn't load pandas
+    import pandas as pd
+    try:
+        import pyarrow as pa  # optional: multithreaded Arrow CSV reader
+        import pyarrow.csv as pacsv
+    except ImportError:
+        pacsv = None
+    if pacsv is not None:
+        # Every column is typed as string up front: left to itself Arrow parses
+        # ISO timestamps and hands them back re-rendered in UTC.
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            header = next(csv.reader(f), [])
+        try:
+            table = pacsv.read_csv(path, convert_options=pacsv.ConvertOptions(
+                column_types={c: pa.string() for c in header},
+                strings_can_be_null=False, quoted_strings_can_be_null=False))
+            return table.to_pandas().fillna("")
+        except pa.ArrowInvalid:
+            pass  # ragged rows (hand-edited sheet); the C parser pads them
+    return pd.read_csv(path, dtype=str, keep_default_na=False, encoding="utf-8",
+                       index_col=False).fillna("")
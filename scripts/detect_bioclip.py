@@ -1,17 +1,42 @@
 # scripts/detect_bioclip.py
 import argparse
 import csv
+import io
+import os
+from collections import OrderedDict
+from hashlib import blake2b
 from pathlib import Path
 from datetime import datetime
 
+# usable cores (honours taskset/cgroup pinning where the OS exposes it)
+try:
+    NCPU = len(os.sched_getaffinity(0))
+except AttributeError:  # Windows / macOS
+    NCPU = os.cpu_count() or 1
+MATH_THREADS = max(1, NCPU // 2)
+# must be set before torch is imported, or MKL/OpenMP size their pools to every core
+os.environ.setdefault("OMP_NUM_THREADS", str(MATH_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(MATH_THREADS))
+
 import pandas as pd
 import torch
+import torch.nn.functional as F
 import open_clip
 from PIL import Image, ImageOps
+from torch.utils.data import DataLoader, Dataset
+
+try:  # optional; only needed for --parquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 REPO = Path(__file__).resolve().parents[1]
 MEDIA_CSV = REPO / "datapackage" / "media.csv"
 OUT_CSV   = REPO / "datapackage" / "detections_bioclip.csv"
+OUT_PARQUET = OUT_CSV.with_suffix(".parquet")
+CACHE_DIR = REPO / "datapackage" / ".cache"
+MODEL_ID  = "hf-hub:imageomics/bioclip-2"
 
 # Camera-trap tuned, multi-prompt labels (robust on night IR)
 CLASS_PROMPTS = {
@@ -38,6 +63,15 @@ CLASS_PROMPTS = {
 }
 CLASS_ORDER = ["blank", "human", "vehicle", "animal"]
 
+TEXT_BATCH = 256  # prompts per encode_text call
+
+# results kept per image content hash, so burst/copy duplicates skip the encoder
+DEDUP_CACHE = 4096
+WRITE_BUFFER = 1 << 20  # 1 MiB output buffer
+
+# --precision -> autocast dtype for the image encoder (None = plain fp32)
+AMP_DTYPES = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
 
 def load_species_list(path: Path) -> list[str]:
     """Load species names from a .txt (one per line) or .csv (column named
@@ -67,18 +101,145 @@ def load_species_list(path: Path) -> list[str]:
     return names
 
 
-def build_text_features(model, tokenizer, device, prompts_by_key: dict[str, list[str]]) -> tuple[torch.Tensor, list[str]]:
+def build_text_features(model, tokenizer, device, prompts_by_key: dict[str, list[str]],
+                        batch_size: int = TEXT_BATCH) -> tuple[torch.Tensor, list[str]]:
     """Average text features for each key over its prompt variants. Returns
-    (features [K,d], keys in order)."""
+    (features [K,d], keys in order). Prompts of all keys are encoded together,
+    batch_size at a time, rather than one encode_text call per key."""
     keys = list(prompts_by_key.keys())
-    feats = []
+    prompts: list[str] = []
+    owners: list[int] = []
+    for i, k in enumerate(keys):
+        prompts += prompts_by_key[k]
+        owners += [i] * len(prompts_by_key[k])
+
     with torch.no_grad():
-        for k in keys:
-            toks = tokenizer(prompts_by_key[k]).to(device)
-            f = model.encode_text(toks)
-            f = f / f.norm(dim=-1, keepdim=True)
-            feats.append(f.mean(dim=0, keepdim=True))
-    return torch.cat(feats, dim=0), keys
+        f = torch.cat([
+            F.normalize(model.encode_text(tokenizer(prompts[j:j + batch_size]).to(device)), dim=-1)
+            for j in range(0, len(prompts), batch_size)
+        ])
+        owner = torch.tensor(owners, device=f.device)
+        sums = torch.zeros(len(keys), f.shape[1], device=f.device, dtype=f.dtype).index_add_(0, owner, f)
+        counts = torch.bincount(owner, minlength=len(keys)).unsqueeze(1)
+    return sums / counts, keys
+
+
+class MediaDS(Dataset):
+    """(mediaID, filePath, image path) records from media.csv. Each item is
+    (mediaID, filePath, content hash of the file bytes, preprocessed image
+    tensor), or None when the file is missing or can't be decoded (dropped
+    again in collate_media)."""
+
+    def __init__(self, records: list[tuple[str, str, str]], preprocess, autocontrast: bool = False):
+        self.records = records
+        self.preprocess = preprocess
+        self.autocontrast = autocontrast
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        mid, fp, img_path = self.records[i]
+        # no exists() pre-check: a missing file fails Image.open just the same
+        try:
+            buf = Path(img_path).read_bytes()
+            img = Image.open(io.BytesIO(buf)).convert("RGB")
+            if self.autocontrast:
+                img = ImageOps.autocontrast(img, cutoff=2)
+            return mid, fp, blake2b(buf, digest_size=8).digest(), self.preprocess(img)
+        except Exception:
+            return None
+
+
+def collate_media(items):
+    """Stack the readable items of a batch; returns (mediaIDs, filePaths,
+    content hashes, images [B,3,H,W]) or None if nothing in the batch could
+    be read."""
+    items = [it for it in items if it is not None]
+    if not items:
+        return None
+    mids, fps, hashes, tensors = zip(*items)
+    return list(mids), list(fps), list(hashes), torch.stack(tensors)
+
+
+def cached_text_features(model, tokenizer, device, prompts_by_key: dict[str, list[str]],
+                         cache_dir: Path | None = CACHE_DIR) -> tuple[torch.Tensor, list[str]]:
+    """build_text_features, memoized on disk under cache_dir, keyed by the
+    model id and the (ordered) prompt dict. cache_dir=None disables the cache."""
+    if cache_dir is None:
+        return build_text_features(model, tokenizer, device, prompts_by_key)
+
+    key = blake2b((MODEL_ID + repr(list(prompts_by_key.items()))).encode(), digest_size=16).hexdigest()
+    path = cache_dir / f"textfeat_{key}.pt"
+    if path.exists():
+        try:
+            cached = torch.load(path, map_location=device, weights_only=True)
+            return cached["feats"], cached["keys"]
+        except Exception as e:
+            print(f"[WARN] Ignoring unreadable text-feature cache {path}: {e}")
+
+    feats, keys = build_text_features(model, tokenizer, device, prompts_by_key)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    torch.save({"feats": feats.cpu(), "keys": keys}, tmp)
+    os.replace(tmp, path)
+    return feats, keys
+
+
+def classify_batch(model, images: torch.Tensor, text_all: torch.Tensor, n_classes: int,
+                   animal_idx: int, amp_dtype: torch.dtype | None = None):
+    """Score a stacked image batch [B,3,H,W] against text_all, the class text
+    features (rows [:n_classes]) stacked on top of the optional species
+    features (rows [n_classes:]), with a single matmul. Returns (cls_idx,
+    cls_prob, sp_idx, sp_prob) tensors of shape [B]; sp_idx is -1 where no
+    species was scored (not an animal, or no species list loaded). With
+    amp_dtype set, the image encoder runs under autocast; scoring is always
+    done in fp32."""
+    with torch.inference_mode():
+        with torch.autocast(images.device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            feats = model.encode_image(images)
+        feats = F.normalize(feats.float(), dim=-1)
+        logits = 100.0 * feats @ text_all.T                  # [B, K+S]
+        probs_cls = logits[:, :n_classes].softmax(dim=-1)   # [B, K]
+        cls_idx = probs_cls.argmax(dim=-1)
+        cls_prob = probs_cls.gather(1, cls_idx.unsqueeze(1)).squeeze(1)
+
+        sp_idx = torch.full_like(cls_idx, -1)
+        sp_prob = torch.zeros_like(cls_prob)
+        mask = cls_idx == animal_idx
+        if text_all.shape[0] > n_classes and bool(mask.any()):
+            # species softmax only over the animal rows
+            probs_sp = logits[mask, n_classes:].softmax(dim=-1)  # [A, S]
+            best_prob, best_idx = probs_sp.max(dim=-1)
+            sp_idx[mask] = best_idx
+            sp_prob[mask] = best_prob
+    return cls_idx, cls_prob, sp_idx, sp_prob
+
+
+OUT_FIELDS = [
+    "mediaID","filePath",
+    "observationType",
+    "classificationMethod","classifiedBy","classificationProbability",
+    "scientificName","speciesProbability",
+]
+
+
+def write_parquet(cols: dict, path: Path) -> None:
+    """Same columns as the CSV, but with the probabilities kept as float32
+    (species is null where none was accepted) and the repetitive strings
+    dictionary-encoded."""
+    dict_str = pa.dictionary(pa.int32(), pa.string())
+    tbl = pa.table({
+        "mediaID": pa.array(cols["mediaID"], pa.string()),
+        "filePath": pa.array(cols["filePath"], pa.string()),
+        "observationType": pa.array(cols["observationType"], dict_str),
+        "classificationMethod": pa.array(cols["classificationMethod"], dict_str),
+        "classifiedBy": pa.array(cols["classifiedBy"], dict_str),
+        "classificationProbability": pa.array(cols["classificationProbability"], pa.float32()),
+        "scientificName": pa.array(cols["scientificName"], dict_str),
+        "speciesProbability": pa.array(cols["speciesProbability"], pa.float32()),
+    })
+    pq.write_table(tbl, path, compression="zstd")
 
 
 def main():
@@ -88,22 +249,60 @@ def main():
     ap.add_argument("--autocontrast", action="store_true", help="Apply autocontrast (helps night/IR)")
     ap.add_argument("--species-file", type=str, default="", help="Path to .txt or .csv of candidate species names")
     ap.add_argument("--min-species-prob", type=float, default=0.40, help="Min prob to accept species name")
+    ap.add_argument("--batch-size", type=int, default=32, help="Images per forward pass")
+    ap.add_argument("--num-workers", "--cpu-io-threads", dest="num_workers", type=int, default=None,
+                    help="Image decode/preprocess worker processes (0 = decode on the main thread; "
+                         "default: the cores left over from --cpu-math-threads on CPU, up to 8 on CUDA)")
+    ap.add_argument("--cpu-math-threads", type=int, default=MATH_THREADS,
+                    help=f"torch intra-op threads on CPU (default: half the usable cores, {MATH_THREADS} here)")
+    ap.add_argument("--precision", default="auto", choices=["auto", *AMP_DTYPES],
+                    help="Image encoder precision (auto = fp16 on CUDA, fp32 on CPU; "
+                         "bf16 is fastest on CPUs with AVX512-BF16/AMX)")
+    ap.add_argument("--compile", action="store_true",
+                    help="torch.compile the image encoder (PyTorch 2.x; first batch pays the compile time)")
+    ap.add_argument("--no-text-cache", action="store_true",
+                    help=f"Always re-encode the text prompts instead of reusing {CACHE_DIR.name}/ features")
+    ap.add_argument("--parquet", action="store_true",
+                    help=f"Also write {OUT_PARQUET.name} (needs pyarrow)")
     args = ap.parse_args()
 
+    if args.parquet and pa is None:
+        raise SystemExit("[ERROR] --parquet needs pyarrow: pip install pyarrow")
+
     if not MEDIA_CSV.exists():
         raise SystemExit(f"[ERROR] Not found: {MEDIA_CSV}. Run your pipeline to produce media.csv first.")
 
-    # Load BioCLIP-2
-    model, preprocess_train, preprocess_val = open_clip.create_model_and_transforms(
-        "hf-hub:imageomics/bioclip-2"
-    )
-    tokenizer = open_clip.get_tokenizer("hf-hub:imageomics/bioclip-2")
-
     device = args.device if (args.device == "cuda" and torch.cuda.is_available()) else "cpu"
+    math_threads = max(1, args.cpu_math_threads)
+    if args.num_workers is None:
+        args.num_workers = min(8, NCPU - math_threads) if device == "cpu" else min(8, NCPU)
+    if device == "cpu":
+        # matmuls get their own cores; decode runs in the DataLoader workers
+        torch.set_num_threads(math_threads)
+        torch.set_num_interop_threads(1)
+
+    # Load BioCLIP-2
+    model, preprocess_train, preprocess_val = open_clip.create_model_and_transforms(MODEL_ID)
+    tokenizer = open_clip.get_tokenizer(MODEL_ID)
     model = model.to(device).eval()
 
+    precision = args.precision
+    if precision == "auto":
+        precision = "fp16" if device == "cuda" else "fp32"
+    if precision == "fp16" and device != "cuda":
+        raise SystemExit("[ERROR] --precision fp16 needs CUDA; use bf16 or fp32 on CPU.")
+    amp_dtype = AMP_DTYPES[precision]
+
+    if args.compile:
+        # fixed-shape specialization; every batch is padded to --batch-size below
+        model.visual = torch.compile(
+            model.visual, dynamic=False,
+            mode="reduce-overhead" if device == "cuda" else "default",
+        )
+
   
-    class_text_features, class_keys = build_text_features(model, tokenizer, device, CLASS_PROMPTS)
+    text_cache = None if args.no_text_cache else CACHE_DIR
+    class_text_features, class_keys = cached_text_features(model, tokenizer, device, CLASS_PROMPTS, text_cache)
   
     order_idx = [class_keys.index(k) for k in CLASS_ORDER]
     class_text_features = class_text_features[order_idx, :]
@@ -124,7 +323,13 @@ def main():
                 ]
                 for name in species_names
             }
-            species_text_features, _ = build_text_features(model, tokenizer, device, species_prompts)
+            species_text_features, _ = cached_text_features(model, tokenizer, device, species_prompts, text_cache)
+
+    # class rows first, then species: one matmul per batch scores both
+    text_all = class_text_features
+    if species_text_features is not None:
+        text_all = torch.cat([class_text_features, species_text_features], dim=0)
+    text_all = text_all.contiguous()
 
     # --- Load media
     df = pd.read_csv(MEDIA_CSV)
@@ -135,71 +340,95 @@ def main():
     if args.limit > 0:
         df = df.iloc[: args.limit].copy()
 
-    rows = []
-    for _, row in df.iterrows():
-        mid = str(row["mediaID"])
-        fp  = str(row["filePath"])
-        img_path = (REPO / fp).resolve() if not Path(fp).is_absolute() else Path(fp)
-        if not Path(img_path).exists():
-            continue
+    animal_idx = class_keys.index("animal")
+    batch_size = max(1, args.batch_size)
 
-        try:
-            img = Image.open(img_path).convert("RGB")
-            if args.autocontrast:
-                img = ImageOps.autocontrast(img, cutoff=2)
-        except Exception:
-            continue
+    # join relative paths onto the repo once, as plain strings (no resolve()/stat per row)
+    fps = df["filePath"].astype(str)
+    img_paths = fps.where(fps.map(os.path.isabs), str(REPO) + os.sep + fps)
+    records = list(zip(df["mediaID"].astype(str), fps, img_paths))
+    workers = max(0, args.num_workers)
+    loader = DataLoader(
+        MediaDS(records, preprocess_val, autocontrast=args.autocontrast),
+        batch_size=batch_size,
+        num_workers=workers,
+        pin_memory=(device == "cuda"),
+        prefetch_factor=4 if workers else None,
+        collate_fn=collate_media,
+    )
 
-        img_t = preprocess_val(img).unsqueeze(0).to(device)
+    # results are collected column-wise; the CSV and Parquet writers both read from here
+    cols = {k: [] for k in OUT_FIELDS}
+    # content hash -> (cls_idx, cls_prob, sp_idx, sp_prob), least recently used first
+    seen: OrderedDict[bytes, tuple] = OrderedDict()
+    n_dup = 0
+    for batch in loader:
+        if batch is None:
+            continue
+        mids, fps, hashes, images = batch
 
-        with torch.no_grad():
-            # classify content (blank/human/vehicle/animal)
-            img_feat = model.encode_image(img_t)
-            img_feat = img_feat / img_feat.norm(dim=-1, keepdim=True)
-            logits_cls = 100.0 * (img_feat @ class_text_features.T)           # [1, 4]
-            probs_cls  = logits_cls.softmax(dim=-1).squeeze(0).tolist()
-            top_cls_idx = int(torch.tensor(probs_cls).argmax().item())
-            obs_type = class_keys[top_cls_idx]
-            obs_prob = float(probs_cls[top_cls_idx])
+        # only encode images whose bytes haven't been scored yet
+        todo: dict[bytes, int] = {}
+        for j, h in enumerate(hashes):
+            if h in seen:
+                seen.move_to_end(h)
+            elif h not in todo:
+                todo[h] = j
+        n_dup += len(hashes) - len(todo)
+        if todo:
+            if len(todo) < len(hashes):
+                images = images[list(todo.values())]
+            if args.compile and len(todo) < batch_size:
+                # keep the compiled graph's input shape; padded rows are never read back
+                images = torch.cat([images, images.new_zeros((batch_size - len(todo), *images.shape[1:]))])
+            images = images.to(device, non_blocking=True)
+            # one device->host copy per result tensor, not a sync per element
+            results = zip(*(t.tolist() for t in classify_batch(
+                model, images, text_all, len(class_keys), animal_idx, amp_dtype
+            )))
+            seen.update(zip(todo, results))
 
+        for mid, fp, h in zip(mids, fps, hashes):
+            ci, cp, k, sp = seen[h]
             # optional species if animal
             species_name = ""
-            species_prob = ""
-            if obs_type == "animal" and species_text_features is not None:
-                logits_sp = 100.0 * (img_feat @ species_text_features.T)      # [1, S]
-                probs_sp  = logits_sp.softmax(dim=-1).squeeze(0)
-                sp_idx = int(torch.argmax(probs_sp).item())
-                sp_prob = float(probs_sp[sp_idx].item())
-                if sp_prob >= args.min_species_prob:
-                    species_name = species_names[sp_idx]
-                    species_prob = f"{sp_prob:.4f}"
-
-        rows.append({
-            "mediaID": mid,
-            "filePath": fp,
-           
-            "observationType": obs_type,                 
-            
-            "classificationMethod": "machine learning",   
-            "classifiedBy": "BioCLIP-2 zero-shot (multi-prompt)",
-            "classificationProbability": f"{obs_prob:.4f}",
-           
-            "scientificName": species_name,
-            "speciesProbability": species_prob,
-        })
+            species_prob = None
+            if k >= 0 and sp >= args.min_species_prob:
+                species_name = species_names[k]
+                species_prob = sp
 
+            cols["mediaID"].append(mid)
+            cols["filePath"].append(fp)
+            cols["observationType"].append(class_keys[ci])
+            cols["classificationMethod"].append("machine learning")
+            cols["classifiedBy"].append("BioCLIP-2 zero-shot (multi-prompt)")
+            cols["classificationProbability"].append(cp)
+            cols["scientificName"].append(species_name)
+            cols["speciesProbability"].append(species_prob)
+
+        while len(seen) > DEDUP_CACHE:
+            seen.popitem(last=False)
+
+    n = len(cols["mediaID"])
+    if n_dup:
+        print(f"[INFO] Reused results for {n_dup} duplicate images")
     OUT_CSV.parent.mkdir(parents=True, exist_ok=True)
-    with OUT_CSV.open("w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=[
-            "mediaID","filePath",
-            "observationType",
-            "classificationMethod","classifiedBy","classificationProbability",
-            "scientificName","speciesProbability",
-        ])
-        w.writeheader()
-        w.writerows(rows)
+    with OUT_CSV.open("w", newline="", encoding="utf-8", buffering=WRITE_BUFFER) as f:
+        w = csv.writer(f)
+        w.writerow(OUT_FIELDS)
+        w.writerows(zip(
+            cols["mediaID"], cols["filePath"],
+            cols["observationType"],
+            cols["classificationMethod"], cols["classifiedBy"],
+            [f"{p:.4f}" for p in cols["classificationProbability"]],
+            cols["scientificName"],
+            ["" if p is None else f"{p:.4f}" for p in cols["speciesProbability"]],
+        ))
+    print(f" Wrote {OUT_CSV} with {n} rows at {datetime.utcnow().isoformat()}Z")
 
-    print(f" Wrote {OUT_CSV} with {len(rows)} rows at {datetime.utcnow().isoformat()}Z")
+    if args.parquet:
+        write_parquet(cols, OUT_PARQUET)
+        print(f" Wrote {OUT_PARQUET}")
 
 
 if __name__ == "__main__":
@@ -5,10 +5,56 @@ import csv
 import argparse
 import subprocess
 import shutil
-import uuid
+import hashlib
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from multiprocessing.util import Finalize
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 
+from csvio import dump_json, load_json
+
+EXIF_CHUNK = 500  # files per exiftool call
+WRITE_BUFFER = 1 << 20  # 1 MiB output buffers
+
+# Tags read by this pipeline (here, link_media_by_serial and build_observations).
+# With --tags-only only these are requested, so exiftool doesn't format every
+# MakerNote/preview/ICC entry for each image. -fast (set in
+# ExifTool.batch) only stops the scan for trailers after the JPEG image data;
+# no -fast2, which skips the MakerNotes, where Reconyx keeps SerialNumber and
+# the trigger info.
+EXIF_TAGS = [
+    "DateTimeOriginal", "CreateDate", "OffsetTimeOriginal", "TimeZoneOffset",
+    "MIMEType", "TriggerMode", "Trigger", "Make", "Model",
+    "GPSLatitude", "GPSLongitude",
+    "SerialNumber", "BodySerialNumber", "EventNumber", "Sequence",
+]
+
+# exifData subset kept in media.csv without --embed-full-exif
+# (what link_media_by_serial and build_observations read back)
+EXIF_DATA_KEYS = (
+    "Make", "Model", "TriggerMode", "GPSLatitude", "GPSLongitude",
+    "SerialNumber", "BodySerialNumber", "EventNumber", "Sequence",
+)
+
+MEDIA_FIELDS = [
+    "mediaID",
+    "deploymentID",
+    "captureMethod",
+    "timestamp",
+    "filePath",
+    "filePublic",
+    "fileName",
+    "fileMediatype",
+    "exifData",
+    "favorite",
+    "mediaComments",
+]
+
 def find_exiftool(user_path: str | None) -> str:
     #  explicit CLI flag
     if user_path:
@@ -53,7 +99,19 @@ def parse_offset(tz_str, tz_num):
     - tz_num like -9 / 2 (EXIF TimeZoneOffset)
     If none provided, return UTC (Z).
     """
-    if tz_str and isinstance(tz_str, str):
+    # EXIF may give an int or list handle both
+    if isinstance(tz_num, list):
+        tz_num = tz_num[0] if tz_num else None
+    if not isinstance(tz_num, (int, float, str)):
+        tz_num = None  # int() would reject it anyway
+    if not isinstance(tz_str, str):
+        tz_str = None
+    # a shoot has only a handful of distinct values, so cache the tzinfo objects
+    return _parse_offset_cached(tz_str, tz_num)
+
+@lru_cache(maxsize=64)
+def _parse_offset_cached(tz_str: str | None, tz_num) -> timezone:
+    if tz_str:
         try:
             sign = 1 if tz_str.startswith("+") else -1
             hh, mm = tz_str[1:].split(":")
@@ -62,9 +120,6 @@ def parse_offset(tz_str, tz_num):
             pass
     if tz_num is not None:
         try:
-            # EXIF may give an int or list handle both
-            if isinstance(tz_num, list) and tz_num:
-                tz_num = tz_num[0]
             hours = int(tz_num)
             return timezone(timedelta(hours=hours))
         except Exception:
@@ -78,16 +133,21 @@ def to_iso_zoned(dt_exif: str | None, offset_time: str | None, tz_num) -> str:
     """
     if not dt_exif:
         return ""
-    # Parse EXIF time
-    dt = datetime.strptime(dt_exif, "%Y:%m:%d %H:%M:%S")
     tz = parse_offset(offset_time, tz_num)
-    dt = dt.replace(tzinfo=tz)
-    # Format to ISO 8601
+    # Parse EXIF time: slice the fixed layout directly, strptime only for
+    # anything else (which then raises the same error as before)
+    s = dt_exif
+    digits = s[0:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19]
+    if (len(s) == 19 and s[4] == s[7] == s[13] == s[16] == ":" and s[10] == " "
+            and digits.isascii() and digits.isdigit()):
+        dt = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                      int(s[11:13]), int(s[14:16]), int(s[17:19]), tzinfo=tz)
+    else:
+        dt = datetime.strptime(s, "%Y:%m:%d %H:%M:%S").replace(tzinfo=tz)
+    # Format to ISO 8601 (isoformat already writes ±HH:MM)
     if dt.utcoffset() == timedelta(0):
-        return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-    # Python prints offsets as ±HHMM; convert to ±HH:MM
-    s = dt.strftime("%Y-%m-%dT%H:%M:%S%z")
-    return s[:-2] + ":" + s[-2:]
+        return dt.isoformat()[:-6] + "Z"
+    return dt.isoformat()
 
 def mimetype_for(path: Path, exif_mime: str | None) -> str:
     if exif_mime and "/" in exif_mime:
@@ -103,69 +163,246 @@ def mimetype_for(path: Path, exif_mime: str | None) -> str:
         ".mp3": "audio/mpeg",
     }.get(ext, "image/jpeg")
 
+# exact trigger strings cameras actually write; anything else goes through the
+# substring checks below (which these agree with)
+_CAP_MAP = {
+    "": "",
+    "motion": "activityDetection",
+    "motion detection": "activityDetection",
+    "activity": "activityDetection",
+    "time lapse": "timeLapse",
+    "timelapse": "timeLapse",
+}
+
 def capture_method_from_exif(md: dict) -> str:
     trig = (md.get("TriggerMode") or md.get("Trigger") or "").lower()
+    cap = _CAP_MAP.get(trig.strip())
+    if cap is not None:
+        return cap
     if "motion" in trig or "activity" in trig:
         return "activityDetection"
     if "time" in trig and "lapse" in trig:
         return "timeLapse"
     return ""  # optional field: empty is OK
 
-def extract_exif(exiftool_path: str, image_path: Path) -> dict:
+def _path_key(p) -> str:
+    # exiftool echoes SourceFile with forward slashes, even on Windows
+    return os.path.normcase(os.path.normpath(str(p)))
+
+class ExifTool:
     """
-    Call exiftool safely on Windows:
-    - Use absolute path (Path.resolve()) to avoid CWD/quoting issues
-    - Pass args as a list (never a single string)
-    - Add '-n' for numeric values and '-json' for clean parsing
-    - shell=False to avoid cmd.exe quoting problems with spaces in paths
+    One persistent `exiftool -stay_open True -@ -` process, so the Perl
+    start-up is paid once per run instead of once per call. Safe on Windows:
+    - Arguments go over stdin one per line (no command-line length limit, no
+      quoting issues with spaces/non-ASCII folder names; filenames as UTF-8)
+    - Binary pipes, read with os.read() up to the {ready} marker and decoded
+      once, rather than line by line through a text wrapper
+    - '-n' for numeric values and '-json' for clean parsing
+    - shell=False to avoid cmd.exe quoting problems
     - Read-only: exiftool writes ONLY to stdout (no sidecars)
+    Use as a context manager so the process is always told to exit.
     """
-    img_abs = image_path.resolve()  # IMPORTANT when folder names have spaces
-    try:
-        result = subprocess.run(
-            [exiftool_path, "-json", "-n", str(img_abs)],
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            shell=False,
-            check=True,  
-            # raise if exiftool returns nonzero
-        )
-    except subprocess.CalledProcessError as e:
-        # Include stderr from exiftool so immediately see the real cause
-        raise RuntimeError(
-            f"exiftool failed for {img_abs} (exit {e.returncode}): {e.stderr.strip()}"
-        ) from e
-    except PermissionError as e:
-        \
-        raise PermissionError(
-            f"Permission error for {img_abs}: {e}. "
-            "If your images are under OneDrive/Defender protection, try "
-            "'Always keep on this device' or write outputs to an 'out/' folder."
-        ) from e
+    SENTINEL = "{ready}"
+    READ_SIZE = 1 << 16
 
+    def __init__(self, exiftool_path: str):
+        try:
+            self.proc = subprocess.Popen(
+                [exiftool_path, "-stay_open", "True", "-@", "-"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=-1,
+                shell=False,
+            )
+        except PermissionError as e:
+            raise PermissionError(
+                f"Permission error running exiftool: {e}. "
+                "If your images are under OneDrive/Defender protection, try "
+                "'Always keep on this device' or write outputs to an 'out/' folder."
+            ) from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.proc.poll() is not None:
+            return
+        try:
+            self.proc.stdin.write(b"-stay_open\nFalse\n")
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+
+    def _read_until_ready(self, stream) -> str:
+        # the marker is the last line exiftool writes for a command, so only
+        # the end of what has been read so far needs checking
+        fd = stream.fileno()
+        marker = self.SENTINEL.encode("ascii")
+        buf = bytearray()
+        while chunk := os.read(fd, self.READ_SIZE):
+            buf += chunk
+            end = len(buf)
+            while end and buf[end - 1] in b"\r\n":
+                end -= 1
+            start = end - len(marker)
+            if start >= 0 and buf[start:end] == marker and (start == 0 or buf[start - 1] == ord("\n")):
+                return buf[:start].decode("utf-8", errors="replace")
+        raise RuntimeError(f"exiftool exited unexpectedly (exit {self.proc.wait()})")
+
+    def _drain_stderr(self, parts: list) -> None:
+        try:
+            parts.append(self._read_until_ready(self.proc.stderr))
+        except RuntimeError:
+            pass  # exiftool died; the stdout read reports it
+
+    def batch(self, paths: list[Path], tags: list[str] | None = None) -> list[dict | None]:
+        """
+        Run one -execute over paths, extracting only tags if given (all tags
+        otherwise). Returns one metadata dict per input path, in input order;
+        None where exiftool returned nothing for that file (unreadable/corrupt).
+        """
+        args = ["-json", "-n", "-fast", "-charset", "filename=utf8",
+                *(f"-{t}" for t in tags or ()), *map(str, paths),
+                "-echo4", self.SENTINEL, "-execute"]
+        # surrogateescape passes undecodable (non-UTF-8) POSIX filenames through as-is
+        self.proc.stdin.write(("\n".join(args) + "\n").encode("utf-8", errors="surrogateescape"))
+        self.proc.stdin.flush()
+        # {ready} ends stdout for this command; -echo4 puts the same marker on
+        # stderr once processing is done. stderr is drained on its own thread
+        # meanwhile: a chunk full of unreadable files can fill that pipe (4 KiB
+        # on Windows) before stdout is done, and exiftool would block on it.
+        err_parts = []
+        err_reader = threading.Thread(target=self._drain_stderr, args=(err_parts,), daemon=True)
+        err_reader.start()
+        out = self._read_until_ready(self.proc.stdout)
+        err_reader.join()
+        err = "".join(err_parts)
+
+        if not out.strip():
+            if err.strip():
+                # Include stderr from exiftool so immediately see the real cause
+                raise RuntimeError(f"exiftool failed: {err.strip()}")
+            return [None] * len(paths)
+
+        try:
+            data = load_json(out)
+        except json.JSONDecodeError as e:
+            snippet = out[:400].replace("\n", " ")
+            raise ValueError(
+                f"Could not parse exiftool JSON: {e}. "
+                f"First 400 chars of stdout: {snippet}"
+            ) from e
+
+        by_path = {_path_key(md.get("SourceFile", "")): md for md in data}
+        return [by_path.get(_path_key(p)) for p in paths]
+
+
+def _batch_pairs(et: ExifTool, chunk: list[Path], tags: list[str] | None):
+    # (path, metadata) pairs for one exiftool command; a chunk exiftool
+    # failed on is reported and left out
     try:
-        data = json.loads(result.stdout)
-    except json.JSONDecodeError as e:
-        snippet = result.stdout[:400].replace("\n", " ")
-        raise ValueError(
-            f"Could not parse exiftool JSON for {img_abs}: {e}. "
-            f"First 400 chars of stdout: {snippet}"
-        ) from e
+        return list(zip(chunk, et.batch(chunk, tags)))
+    except Exception as e:
+        print(f"[WARN] Skipping {len(chunk)} files from {chunk[0]} on → {e}")
+        return []
+
+def iter_exif_serial(exiftool_path: str, paths: list[Path],
+                    tags: list[str] | None = None):
+    """
+    EXIF for paths through one stay_open exiftool, in EXIF_CHUNK-sized
+    commands. Yields (path, metadata) pairs in input order as each chunk
+    comes back.
+    """
+    with ExifTool(exiftool_path) as et:
+        for start in range(0, len(paths), EXIF_CHUNK):
+            yield from _batch_pairs(et, paths[start:start + EXIF_CHUNK], tags)
 
-    if not data:
-        raise ValueError(f"No EXIF data returned for {img_abs}")
-    return data[0]
+# the worker process's own exiftool, started by the pool initializer
+_worker_et: ExifTool | None = None
 
+def _init_exif_worker(exiftool_path: str) -> None:
+    global _worker_et
+    _worker_et = ExifTool(exiftool_path)
+    # pool workers leave through multiprocessing's exit hooks, not atexit
+    Finalize(_worker_et, _worker_et.close, exitpriority=10)
+
+def exif_worker(chunk: list[Path], tags: list[str] | None = None) -> list[tuple[Path, dict | None]]:
+    # ProcessPoolExecutor entry point: one chunk through this worker's exiftool
+    return _batch_pairs(_worker_et, chunk, tags)
+
+def iter_exif(exiftool_path: str, paths: list[Path], tags: list[str] | None, workers: int):
+    """
+    (path, metadata) pairs for all paths, in order. With workers > 1, one
+    exiftool per worker process; EXIF_CHUNK-sized chunks are handed out with
+    at most 2 per worker in flight and yielded in submission order, so memory
+    and the wait for the first rows stay bounded by the chunk size.
+    """
+    chunks = [paths[i:i + EXIF_CHUNK] for i in range(0, len(paths), EXIF_CHUNK)]
+    n = max(1, min(workers, len(chunks)))
+    if n == 1:
+        yield from iter_exif_serial(exiftool_path, paths, tags)
+        return
+    todo = iter(chunks)
+    with ProcessPoolExecutor(max_workers=n, initializer=_init_exif_worker,
+                             initargs=(exiftool_path,)) as pool:
+        pending = deque(pool.submit(exif_worker, c, tags) for c in islice(todo, 2 * n))
+        while pending:
+            part = pending.popleft().result()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append(pool.submit(exif_worker, nxt, tags))
+            yield from part
+
+def write_outputs(q: queue.Queue, f, jf, errors: list) -> None:
+    """
+    Writer thread body: takes (csv_row, json_entry) items off q until the None
+    sentinel and writes them to media.csv and media_metadata.json (a JSON
+    array, one entry per line), so disk writes overlap with exiftool reading
+    the next chunk. The first write error is put in errors; q is still
+    drained so the producer never blocks on it.
+    """
+    try:
+        writer = csv.writer(f)
+        writer.writerow(MEDIA_FIELDS)
+        jf.write("[")
+        first = True
+        while (item := q.get()) is not None:
+            row, entry = item
+            writer.writerow(row)
+            jf.write("\n" if first else ",\n")
+            jf.write(entry)
+            first = False
+        jf.write("\n]\n")
+    except Exception as e:
+        errors.append(e)
+        while q.get() is not None:
+            pass
+
+MEDIA_EXTS = (".jpg", ".jpeg", ".png")
 
 def iter_media(root: Path, recursive: bool) -> list[Path]:
-    exts = ("*.jpg", "*.jpeg", "*.png", "*.JPG", "*.JPEG", "*.PNG")
-    files = []
-    walker = root.rglob if recursive else root.glob
-    for pat in exts:
-        files.extend(walker(pat))
-    return sorted({p.resolve() for p in files})
+    # one pass over the tree (not one per extension), extensions in any case;
+    # paths are unique by construction, so no resolve()/set needed
+    if recursive:
+        files = [os.path.join(d, n) for d, _, names in os.walk(root)
+                 for n in names if n.lower().endswith(MEDIA_EXTS)]
+    else:
+        with os.scandir(root) as it:
+            files = [e.path for e in it if not e.is_dir() and e.name.lower().endswith(MEDIA_EXTS)]
+    return sorted(Path(f) for f in files)
+
+def read_file_list(list_path: Path, root: Path) -> list[Path]:
+    # one media path per line (UTF-8), relative ones taken from root; blank
+    # lines and non-media extensions ignored (as in iter_media), order kept
+    with open(list_path, encoding="utf-8") as f:
+        return [Path(os.path.normpath(os.path.join(root, line)))
+                for line in f.read().splitlines()
+                if line.strip() and line.lower().endswith(MEDIA_EXTS)]
 
 def main():
     parser = argparse.ArgumentParser(description="Write Camtrap DP-compliant media.csv from image EXIF.")
@@ -177,6 +414,13 @@ def main():
     parser.add_argument("--recursive", action="store_true")
     parser.add_argument("--file-public", default="false", choices=["true", "false"], help="Required by schema; default false")
     parser.add_argument("--embed-full-exif", action="store_true", help="Store the full EXIF object in exifData")
+    parser.add_argument("--tags-only", action="store_true",
+                        help="Only read the tags the pipeline uses (media_metadata.json then holds just those)")
+    parser.add_argument("--files-from", default=None,
+                        help="Text file listing the media to read, one path per line (relative to --data-dir); "
+                             "replaces the directory scan")
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 4),
+                        help="Parallel exiftool processes (default: CPU count, up to 4)")
     args = parser.parse_args()
 
     data_dir = Path(args.data_dir).resolve()
@@ -194,7 +438,14 @@ def main():
         print(f"[ERROR] {e}")
         sys.exit(1)
 
-    media_files = iter_media(data_dir, args.recursive)
+    if args.files_from:
+        try:
+            media_files = read_file_list(Path(args.files_from), data_dir)
+        except OSError as e:
+            print(f"[ERROR] Could not read --files-from: {e}")
+            sys.exit(1)
+    else:
+        media_files = iter_media(data_dir, args.recursive)
     if not media_files:
         print(f"[WARN] No media found in {data_dir}.")
         sys.exit(0)
@@ -202,89 +453,88 @@ def main():
     out_media.parent.mkdir(parents=True, exist_ok=True)
     out_json.parent.mkdir(parents=True, exist_ok=True)
 
-    all_raw = []
-    with out_media.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                "mediaID",
-                "deploymentID",
-                "captureMethod",
-                "timestamp",
-                "filePath",
-                "filePublic",
-                "fileName",
-                "fileMediatype",
-                "exifData",
-                "favorite",
-                "mediaComments",
-            ],
-        )
-        writer.writeheader()
-
-        for p in media_files:
-            try:
-                md = extract_exif(exiftool_path, p)
-
-                # Timestamp with time zone
-                dt_exif = md.get("DateTimeOriginal") or md.get("CreateDate")
-                offset_time = md.get("OffsetTimeOriginal")  # e.g. "-09:00"
-                tz_num = md.get("TimeZoneOffset")           # e.g. -9 or [ -9, -9 ]
-                iso_ts = to_iso_zoned(dt_exif, offset_time, tz_num)
-
-                # filePath as orward slashes and relative if possible
-                repo_root = Path(__file__).parent.parent.resolve()
+    tags = EXIF_TAGS if args.tags_only and not args.embed_full_exif else None
+    results = iter_exif(exiftool_path, media_files, tags, args.workers)
+
+    repo_root = Path(__file__).parent.parent.resolve()
+    n_rows = 0
+    # rows are handed to a writer thread through a bounded queue (in order,
+    # single producer) while this thread waits on exiftool for the next chunk
+    q = queue.Queue(maxsize=256)
+    write_errors = []
+    with out_media.open("w", newline="", encoding="utf-8", buffering=WRITE_BUFFER) as f, \
+         out_json.open("w", encoding="utf-8", buffering=WRITE_BUFFER) as jf:
+        writer_thread = threading.Thread(target=write_outputs, args=(q, f, jf, write_errors), daemon=True)
+        writer_thread.start()
+        try:
+            for p, md in results:
                 try:
-                    rel = p.resolve().relative_to(repo_root).as_posix()
-                except Exception:
-                    rel = p.resolve().as_posix()
-
-                # fileName & mediatype
-                file_name = p.name
-                file_mime = mimetype_for(p, md.get("MIMEType"))
-
-                # captureMethod
-                capture_method = capture_method_from_exif(md)
-
-                # exifData: embed full EXIF or a small subset
-                exif_obj = md if args.embed_full_exif else {
-                    "Make": md.get("Make"),
-                    "Model": md.get("Model"),
-                    "TriggerMode": md.get("TriggerMode"),
-                    "GPSLatitude": md.get("GPSLatitude"),
-                    "GPSLongitude": md.get("GPSLongitude"),
-                }
-                exif_json = json.dumps(exif_obj, ensure_ascii=False)
-
-                
-
-                row = {
-                   #"mediaID": Path(file_name).stem, #Can be used for a short ID, but may not be unique
-                   # "mediaID": f"{Path(file_name).stem}_{uuid.uuid4().hex[:8]}", Or combine with a UUID for uniqueness
-                   "mediaID": uuid.uuid4().hex[:8],   # short unique ID   
-                    "deploymentID": args.deployment_id,
-                    "captureMethod": capture_method or "",
-                    "timestamp": iso_ts,
-                    "filePath": rel,
-                    "filePublic": "true" if file_public else "false",
-                    "fileName": file_name,
-                    "fileMediatype": file_mime,
-                    "exifData": exif_json,
-                    "favorite": "",
-                    "mediaComments": "",
-                }
-
-                writer.writerow(row)
-                all_raw.append({"file": str(p), "metadata": md})
-
-            except Exception as e:
-                print(f"[WARN] Skipping {p} → {e}")
-
-    with out_json.open("w", encoding="utf-8") as jf:
-        json.dump(all_raw, jf, indent=2)
+                    if md is None:
+                        raise ValueError(f"No EXIF data returned for {p}")
+
+                    # Timestamp with time zone
+                    dt_exif = md.get("DateTimeOriginal") or md.get("CreateDate")
+                    offset_time = md.get("OffsetTimeOriginal")  # e.g. "-09:00"
+                    tz_num = md.get("TimeZoneOffset")           # e.g. -9 or [ -9, -9 ]
+                    iso_ts = to_iso_zoned(dt_exif, offset_time, tz_num)
+
+                    # filePath as orward slashes and relative if possible
+                    # (p is already absolute: iter_media walks the resolved data dir)
+                    try:
+                        rel = p.relative_to(repo_root).as_posix()
+                    except ValueError:
+                        rel = p.as_posix()
+
+                    # fileName & mediatype
+                    file_name = p.name
+                    file_mime = mimetype_for(p, md.get("MIMEType"))
+
+                    # captureMethod
+                    capture_method = capture_method_from_exif(md)
+
+                    # exifData: embed full EXIF or a small subset; absent tags are
+                    # left out rather than written as null (build_observations
+                    # probes the raw cell for EventNumber/Sequence)
+                    exif_obj = md if args.embed_full_exif else {
+                        k: md[k] for k in EXIF_DATA_KEYS if md.get(k) is not None
+                    }
+                    exif_json = dump_json(exif_obj)
+
+            
+
+                    #mediaID = Path(file_name).stem #Can be used for a short ID, but may not be unique
+                    # mediaID = f"{Path(file_name).stem}_{uuid.uuid4().hex[:8]}" Or combine with a UUID for uniqueness
+                    # short ID hashed from filePath, so re-running gives the same IDs
+                    media_id = hashlib.blake2b(rel.encode("utf-8"), digest_size=4).hexdigest()
+
+                    # same order as MEDIA_FIELDS
+                    row = (
+                        media_id,
+                        args.deployment_id,
+                        capture_method or "",
+                        iso_ts,
+                        rel,
+                        "true" if file_public else "false",
+                        file_name,
+                        file_mime,
+                        exif_json,
+                        "",  # favorite
+                        "",  # mediaComments
+                    )
+                    q.put((row, dump_json({"file": str(p), "metadata": md})))
+                    n_rows += 1
+
+                except Exception as e:
+                    print(f"[WARN] Skipping {p} → {e}")
+        finally:
+            q.put(None)
+            writer_thread.join()
+
+    if write_errors:
+        raise write_errors[0]
 
     print(" media.csv written in Camtrap DP shape.")
-    print(f"   Rows: {len(all_raw)}")
+    print(f"   Rows: {n_rows}")
     print(f"   CSV : {out_media}")
     print(f"   JSON: {out_json}")
 
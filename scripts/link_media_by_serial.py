@@ -1,41 +1,95 @@
+import argparse
 import csv
-import json
+import os
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 from pathlib import Path
-from datetime import timezone
+from datetime import datetime, timezone
+import pandas as pd
 from dateutil import parser as dtparse  # pip install python-dateutil
 
+from csvio import load_frame, load_json
+
 REPO = Path(__file__).resolve().parents[1]
+REPO_STR = str(REPO)  # for plain string joins in the per-row fallback
 MEDIA_IN   = REPO / "datapackage" / "media.csv"
 MEDIA_JSON = REPO / "datapackage" / "media_metadata.json"   # optional fallback
 DEPLOY_CSV = REPO / "datapackage" / "deployments.csv"
 MEDIA_OUT  = REPO / "datapackage" / "media_linked.csv"
+WRITE_BUFFER = 1 << 20  # 1 MiB output buffer
+BATCH_SIZE = 50_000  # media rows read per batch
+
+# open-ended deployment windows (no start / no end)
+MIN_DT = datetime.min.replace(tzinfo=timezone.utc)
+MAX_DT = datetime.max.replace(tzinfo=timezone.utc)
+
+@lru_cache(maxsize=4096)
+def parse_dt(s: str) -> datetime:
+    """Our scripts write ISO 8601, which fromisoformat handles directly (the
+    'Z' suffix only from 3.11 on); dateutil covers anything hand-edited."""
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        return dtparse.parse(s)
+
+class SerialDeployments:
+    """One camera's deployments ({deploymentID,start,end}), sorted by start so
+    choose_deployment can bisect instead of scanning every window."""
+
+    def __init__(self, deps: list[dict]):
+        # stable sort: order[k] is the sheet position of deps[k]
+        self.order = sorted(range(len(deps)), key=lambda k: deps[k]["start"] or MIN_DT)
+        self.deps = [deps[k] for k in self.order]
+        self.starts = [d["start"] or MIN_DT for d in self.deps]
+        # running max of the end bounds, to know when no earlier window can still match
+        self.max_end = list(accumulate((d["end"] or MAX_DT for d in self.deps), max))
+
+    def __len__(self):
+        return len(self.deps)
 
 def load_deployments_by_serial():
-    """serial -> list of {deploymentID,start,end}"""
+    """serial -> SerialDeployments"""
+    dep = load_frame(DEPLOY_CSV)
+
+    def col(name: str) -> pd.Series:
+        return dep[name] if name in dep.columns else pd.Series("", index=dep.index)
+
+    serials = col("cameraID").where(col("cameraID") != "", col("deviceID")).str.strip()
     idx = {}
-    with DEPLOY_CSV.open("r", encoding="utf-8") as f:
-        r = csv.DictReader(f)
-        for row in r:
-            serial = (row.get("cameraID") or row.get("deviceID") or "").strip()
-            if not serial:
-                continue
-            start = dtparse.parse(row["deploymentStart"]) if row.get("deploymentStart") else None
-            end   = dtparse.parse(row["deploymentEnd"])   if row.get("deploymentEnd") else None
-            idx.setdefault(serial, []).append({
-                "deploymentID": row["deploymentID"],
-                "start": start,
-                "end": end
-            })
-    return idx
+    for serial, dep_id, s, e in zip(serials, dep["deploymentID"], col("deploymentStart"), col("deploymentEnd")):
+        if not serial:
+            continue
+        idx.setdefault(serial, []).append({
+            "deploymentID": dep_id,
+            "start": parse_dt(s) if s else None,
+            "end": parse_dt(e) if e else None,
+        })
+    return {serial: SerialDeployments(deps) for serial, deps in idx.items()}
+
+def _path_key(p) -> str:
+    return os.path.normcase(os.path.normpath(str(p)))
+
+class LazyMediaIndex:
+    """absolute file path -> EXIF dict (fallback if exifData column is empty).
+    media_metadata.json is only read on the first lookup, which never happens
+    when every media row carries its own exifData."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._idx = None
+
+    def get(self, file_path, default=None):
+        if self._idx is None:
+            self._idx = {}
+            if self.path.exists():
+                # extract_exif writes already-resolved absolute paths
+                for item in load_json(self.path.read_text(encoding="utf-8")):
+                    self._idx[_path_key(item["file"])] = item.get("metadata", {})
+        return self._idx.get(_path_key(file_path), default)
 
 def index_media_json():
-    """absolute file path -> EXIF dict (fallback if exifData column is empty)"""
-    idx = {}
-    if MEDIA_JSON.exists():
-        data = json.loads(MEDIA_JSON.read_text(encoding="utf-8"))
-        for item in data:
-            idx[str(Path(item["file"]).resolve())] = item.get("metadata", {})
-    return idx
+    return LazyMediaIndex(MEDIA_JSON)
 
 def get_serial_from_media_row(row, fallback_by_abspath):
     # Prefer embedded exifData (Camtrap DP column)
@@ -43,13 +97,13 @@ def get_serial_from_media_row(row, fallback_by_abspath):
     exif_str = (row.get("exifData") or "").strip()
     if exif_str:
         try:
-            md = json.loads(exif_str)
+            md = load_json(exif_str)
         except Exception:
             md = {}
     # Fallback to media_metadata.json if needed
     if not md and fallback_by_abspath:
-        abs_guess = str((REPO / row["filePath"]).resolve())
-        md = fallback_by_abspath.get(abs_guess, {})
+        # filePath is repo-relative posix (or absolute); the index normalizes the key
+        md = fallback_by_abspath.get(os.path.join(REPO_STR, row["filePath"]), {})
     # Common keys
     return (md.get("SerialNumber") or md.get("BodySerialNumber") or "").strip()
 
@@ -57,7 +111,7 @@ def parse_ts(row):
     t = (row.get("timestamp") or "").strip()
     if not t:
         return None
-    dt = dtparse.parse(t)
+    dt = parse_dt(t)
     return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
 
 def choose_deployment(cands, when):
@@ -65,16 +119,26 @@ def choose_deployment(cands, when):
     if not cands:
         return None
     if len(cands) == 1:
-        return cands[0]["deploymentID"]
+        return cands.deps[0]["deploymentID"]
     if when is None:
         return None
-    for dep in cands:
-        s, e = dep["start"], dep["end"]
-        if (s is None or when >= s) and (e is None or when <= e):
-            return dep["deploymentID"]
-    return None
+    # windows starting at or before `when`; of those that haven't ended yet,
+    # the one listed first in deployments.csv wins (matters only for overlaps)
+    best = None
+    for k in range(bisect_right(cands.starts, when) - 1, -1, -1):
+        if cands.max_end[k] < when:
+            break
+        e = cands.deps[k]["end"]
+        if (e is None or when <= e) and (best is None or cands.order[k] < cands.order[best]):
+            best = k
+    return cands.deps[best]["deploymentID"] if best is not None else None
 
 def main():
+    ap = argparse.ArgumentParser(description="Fill media.csv deploymentIDs from camera serial + timestamp.")
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                    help=f"media rows read and written per batch (default {BATCH_SIZE})")
+    args = ap.parse_args()
+
     print("[INFO] Loading deployments…")
     by_serial = load_deployments_by_serial()
     print(f"[INFO] Serials in deployments: {len(by_serial)}")
@@ -86,29 +150,40 @@ def main():
         print(f"[ERROR] Not found: {MEDIA_IN}")
         return
 
-    with MEDIA_IN.open("r", encoding="utf-8") as fin, MEDIA_OUT.open("w", newline="", encoding="utf-8") as fout:
-        r = csv.DictReader(fin)
-        w = csv.DictWriter(fout, fieldnames=r.fieldnames)
-        w.writeheader()
+    # media.csv is read in batches with the pandas C parser (the Arrow engine
+    # can't chunk), so memory stays bounded however many images there are
+    try:
+        batches = pd.read_csv(MEDIA_IN, dtype=str, keep_default_na=False, encoding="utf-8",
+                              index_col=False, chunksize=max(1, args.batch_size))
+    except pd.errors.EmptyDataError:
+        print(f"[ERROR] No header row found in {MEDIA_IN}")
+        return
 
-        total, linked, warn_missing_serial, warn_ambiguous = 0, 0, 0, 0
+    total, linked, warn_missing_serial, warn_ambiguous = 0, 0, 0, 0
 
-        for row in r:
-            total += 1
+    with batches, MEDIA_OUT.open("w", newline="", encoding="utf-8", buffering=WRITE_BUFFER) as fout:
+        header = True
+        for df in batches:
+            df = df.fillna("")  # short rows
+            if header:
+                csv.writer(fout).writerow(df.columns)
+                header = False
+            total += len(df)
             # skip blank lines
-            if not any((row.get(k) or "").strip() for k in (r.fieldnames or [])):
-                continue
-
-            serial = get_serial_from_media_row(row, meta_idx)
-            when   = parse_ts(row)
+            df = df[df.apply(lambda c: c.str.strip() != "").any(axis=1)]
+            if "deploymentID" not in df.columns:
+                df["deploymentID"] = ""
 
-            chosen = row.get("deploymentID","").strip()
+            chosen = df["deploymentID"].str.strip()
             # Only (re)assign if missing or placeholder
-            if not chosen or chosen.upper().startswith("DEPLOY"):
+            todo = df[(chosen == "") | chosen.str.upper().str.startswith("DEPLOY")]
+            for i, row in zip(todo.index, todo.to_dict("records")):
+                serial = get_serial_from_media_row(row, meta_idx)
+                when   = parse_ts(row)
                 cands = by_serial.get(serial, [])
                 picked = choose_deployment(cands, when)
                 if picked:
-                    row["deploymentID"] = picked
+                    df.at[i, "deploymentID"] = picked
                     linked += 1
                 else:
                     if not serial:
@@ -117,7 +192,8 @@ def main():
                         warn_ambiguous += 1
                     # leave as-is 
 
-            w.writerow(row)
+            # same CRLF line endings the csv module writes
+            df.to_csv(fout, header=False, index=False, lineterminator="\r\n")
 
     print(f" Linked {linked}/{total} media rows")
     if warn_missing_serial:
@@ -1,10 +1,13 @@
 # scripts/merge_labels.py
-import csv
 from pathlib import Path
 import argparse
 import sys
 from datetime import datetime
 
+import pandas as pd
+
+from csvio import load_frame
+
 # Fields that humans are allowed to edit (same as before)
 EDITABLE = {
     "observationType",       # enum: animal|human|vehicle|blank|unknown|unclassified
@@ -45,10 +48,8 @@ REQUIRED_OBS_FIELDS = [
     "observationTags","observationComments"
 ]
 
-def load_csv(path):
-    with open(path, newline="", encoding="utf-8") as f:
-        r = csv.DictReader(f)
-        return list(r), list(r.fieldnames)
+def strip_all(df: pd.DataFrame) -> pd.DataFrame:
+    return df.apply(lambda c: c.str.strip())
 
 def validate_row(edits):
     # Minimal validation to avoid schema conflicts (human edits only)
@@ -92,33 +93,41 @@ def main():
     args = p.parse_args()
 
     # Load observations
-    obs_rows, obs_fields = load_csv(args.observations)
-    obs_fields = ensure_fields(obs_fields)
+    obs = load_frame(args.observations)
+    obs_fields = ensure_fields(obs.columns)
+    obs = obs.reindex(columns=obs_fields, fill_value="")
 
     #  1) Apply HUMAN labels (priority)
     try:
-        lab_rows, lab_fields = load_csv(args.labels)
+        lab = load_frame(args.labels)
     except FileNotFoundError:
-        lab_rows, lab_fields = ([], [])
+        lab = pd.DataFrame(columns=["observationID"], dtype=str)
         print(f"[INFO] No human label file found at {args.labels}; skipping human merge.")
 
-    # Index observations by observationID for human merge
-    idx_by_oid = {r.get("observationID", ""): r for r in obs_rows}
+    # Index observations (row labels) by observationID for human merge
+    idx_by_oid = {oid: i for i, oid in enumerate(obs["observationID"])}
+
+    # stripped editable values as one tuple per row, for labels and observations alike
+    edit_cols = [c for c in lab.columns if c in EDITABLE]
+    lab_oids = lab["observationID"].str.strip() if "observationID" in lab.columns else [""] * len(lab)
+    lab_vals = strip_all(lab[edit_cols]).itertuples(index=False, name=None)
+    obs_vals = list(strip_all(obs[edit_cols]).itertuples(index=False, name=None))
 
-    editable_present = [c for c in lab_fields if c in EDITABLE]
     updated_human = 0
-    for lab in lab_rows:
-        oid = lab.get("observationID", "").strip()
+    for oid, vals in zip(lab_oids, lab_vals):
         if not oid or oid not in idx_by_oid:
             continue
 
-        obs = idx_by_oid[oid]
+        i = idx_by_oid[oid]
+        cur_vals = obs_vals[i]
+        # nothing filled in, or identical to the observation: no edit
+        if vals == cur_vals or not any(vals):
+            continue
+
         changed = {}
-        for k in editable_present:
-            v = (lab.get(k) or "").strip()
-            if v == "":
+        for k, v, cur in zip(edit_cols, vals, cur_vals):
+            if v == "" or v == cur:
                 continue
-            cur = (obs.get(k) or "").strip()
 
             if k == "observationType":
                 v_norm = v.lower()
@@ -129,9 +138,6 @@ def main():
                     continue
                 if v_norm == cur_norm:
                     continue
-            else:
-                if v == cur:
-                    continue
 
             changed[k] = v
 
@@ -146,113 +152,81 @@ def main():
             continue
 
         for k, v in changed.items():
-            obs[k] = v
+            obs.at[i, k] = v
+        obs_vals[i] = tuple(changed.get(k, cur) for k, cur in zip(edit_cols, cur_vals))
 
         # Mark classification as human ONLY when there was a real change
-        cm = (obs.get("classificationMethod","") or "").strip().lower()
+        cm = obs.at[i, "classificationMethod"].strip().lower()
         if cm in ("", "machine learning"):
-            obs["classificationMethod"] = "human"
-            obs["classifiedBy"] = obs.get("classifiedBy") or "human"
-            obs["classificationTimestamp"] = datetime.utcnow().isoformat(timespec="seconds")+"Z"
+            obs.at[i, "classificationMethod"] = "human"
+            obs.at[i, "classifiedBy"] = obs.at[i, "classifiedBy"] or "human"
+            obs.at[i, "classificationTimestamp"] = datetime.utcnow().isoformat(timespec="seconds")+"Z"
 
         updated_human += 1
 
 
     # ---- 2) Apply AI labels where fields are still empty (or were previously ML) ----
-    ai_rows = []
+    ai_cols = ["mediaID", "observationType", "scientificName", "classifiedBy", "classificationProbability"]
     try:
-        ai_rows, ai_fields = load_csv(args.ai)
+        ai = load_frame(args.ai).reindex(columns=ai_cols, fill_value="")
     except FileNotFoundError:
-        ai_rows = []
+        ai = pd.DataFrame(columns=ai_cols, dtype=str)
         print(f"[INFO] No AI file found at {args.ai}; skipping AI merge.")
 
-    # Build index from mediaID -> best AI row (if multiples, keep highest prob)
-    ai_by_media = {}
-    for r in ai_rows:
-        mid = (r.get("mediaID") or "").strip()
-        if not mid:
-            continue
-        try:
-            p = float((r.get("classificationProbability") or "0").strip())
-        except Exception:
-            p = 0.0
-        # keep the highest-probability entry per mediaID
-        prev = ai_by_media.get(mid)
-        if prev is None or p > float((prev.get("classificationProbability") or "0")):
-            ai_by_media[mid] = r
-
-    updated_ai, skipped_lowconf, skipped_human_override, missing_ai = 0, 0, 0, 0
-    for obs in obs_rows:
-        mid = (obs.get("mediaID") or "").strip()
-        if not mid:
-            continue
-
-        ai = ai_by_media.get(mid)
-        if not ai:
-            missing_ai += 1
-            continue
-
-        # parse AI probability
-        try:
-            ai_prob = float((ai.get("classificationProbability") or "0").strip())
-        except Exception:
-            ai_prob = 0.0
-
-        if ai_prob < args.ai_threshold:
-            skipped_lowconf += 1
-            continue
-
-        # Do NOT override human labels:
-        # If classificationMethod is explicitly "human" (or any non-ML non-empty), skip AI
-        cm = (obs.get("classificationMethod","") or "").strip().lower()
-        if cm and cm != AI_METHOD:
-            skipped_human_override += 1
-            continue
-
-        # Merge strategy: fill only empty fields OR fields that were previously set by machine learning
-        def should_fill(field_name: str) -> bool:
-            v = (obs.get(field_name) or "").strip()
-            if not v:
-                return True
-            # allow ML to overwrite prior ML values; but never overwrite human-provided values
-            return cm == AI_METHOD and field_name in ("observationType","scientificName",
-                                                      "classificationMethod","classifiedBy",
-                                                      "classificationTimestamp","classificationProbability")
-
-        # Apply AI -> observation fields
-        applied = False
-        # observationType
-        if should_fill("observationType"):
-            val = (ai.get("observationType") or "").strip()
-            if not val or val not in OBSERVATION_TYPE_ENUM:
-                val = "unknown"
-            obs["observationType"] = val
-            applied = True
-
-        # scientificName (optional)
-        if should_fill("scientificName"):
-            obs["scientificName"] = (ai.get("scientificName") or "").strip()
-            # count/lifeStage/sex remain user-editable; leave blank
-
-        # classification metadata
-        if should_fill("classificationMethod"):
-            obs["classificationMethod"] = AI_METHOD
-        if should_fill("classifiedBy"):
-            obs["classifiedBy"] = (ai.get("classifiedBy") or AI_CLASSIFIED_BY).strip() or AI_CLASSIFIED_BY
-        if should_fill("classificationTimestamp"):
-            obs["classificationTimestamp"] = datetime.utcnow().isoformat(timespec="seconds")+"Z"
-        if should_fill("classificationProbability"):
-            obs["classificationProbability"] = (ai.get("classificationProbability") or "").strip()
-
-        if applied:
-            updated_ai += 1
+    # mediaID -> best AI row (if multiples, keep the first highest-prob one)
+    ai = strip_all(ai)
+    ai["p"] = pd.to_numeric(ai["classificationProbability"], errors="coerce").fillna(0.0)
+    ai = ai[ai["mediaID"] != ""].sort_values("p", ascending=False, kind="stable")
+    best = ai.drop_duplicates("mediaID").set_index("mediaID")
+
+    # every decision below is a boolean mask over the observation rows
+    mid = obs["mediaID"].str.strip()
+    ai_prob = mid.map(best["p"])                    # NaN where there is no AI row
+    matched = (mid != "") & ai_prob.notna()
+    lowconf = matched & (ai_prob < args.ai_threshold)
+    # Do NOT override human labels:
+    # If classificationMethod is explicitly "human" (or any non-ML non-empty), skip AI
+    cm = obs["classificationMethod"].str.strip().str.lower()
+    human_override = matched & ~lowconf & (cm != "") & (cm != AI_METHOD)
+    apply_ai = matched & ~lowconf & ~human_override
+
+    missing_ai = int(((mid != "") & ai_prob.isna()).sum())
+    skipped_lowconf = int(lowconf.sum())
+    skipped_human_override = int(human_override.sum())
+
+    # Merge strategy: fill only empty fields OR fields that were previously set
+    # by machine learning (never overwrite human-provided values)
+    def should_fill(field_name: str) -> pd.Series:
+        return apply_ai & ((obs[field_name].str.strip() == "") | (cm == AI_METHOD))
+
+    def ai_value(field_name: str) -> pd.Series:
+        return mid.map(best[field_name])
+
+    # Apply AI -> observation fields
+    fill = should_fill("observationType")
+    ot = ai_value("observationType")
+    obs.loc[fill, "observationType"] = ot.where(ot.isin(OBSERVATION_TYPE_ENUM), "unknown")[fill]
+    updated_ai = int(fill.sum())
+
+    # scientificName (optional); count/lifeStage/sex remain user-editable
+    fill = should_fill("scientificName")
+    obs.loc[fill, "scientificName"] = ai_value("scientificName")[fill]
+
+    # classification metadata
+    fill = should_fill("classificationMethod")
+    obs.loc[fill, "classificationMethod"] = AI_METHOD
+    fill = should_fill("classifiedBy")
+    by = ai_value("classifiedBy")
+    obs.loc[fill, "classifiedBy"] = by.where(by != "", AI_CLASSIFIED_BY)[fill]
+    fill = should_fill("classificationTimestamp")
+    obs.loc[fill, "classificationTimestamp"] = datetime.utcnow().isoformat(timespec="seconds")+"Z"
+    fill = should_fill("classificationProbability")
+    obs.loc[fill, "classificationProbability"] = ai_value("classificationProbability")[fill]
 
     # ---- Write output ----
     out_path = Path(args.out)
-    with out_path.open("w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=obs_fields)
-        w.writeheader()
-        w.writerows(obs_rows)
+    # same CRLF line endings the csv module writes
+    obs.to_csv(out_path, index=False, encoding="utf-8", lineterminator="\r\n")
 
     print(f" Human-updated: {updated_human}")
     print(f" AI-filled    : {updated_ai}")
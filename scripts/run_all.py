@@ -1,54 +1,208 @@
 # scripts/run_all.py
+import argparse
+import asyncio
+import csv
+import json
 import os
-import subprocess
 import sys
+from functools import lru_cache
 from pathlib import Path
-from shutil import copyfile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:  # optional; only needed for --parquet
+    import pyarrow as pa
+    import pyarrow.csv as pac
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pac = pq = None
 
 # repo root + standard locations
 ROOT = Path(__file__).resolve().parents[1]
 DP   = ROOT / "datapackage"
+SCRIPTS = ROOT / "scripts"
 
 # I prefer to keep raw media outside the repo to avoid Defender/OneDrive issues.
 # If CAMTRAP_DATA_DIR is set, use it; otherwise default to repo/data.
 DATA = Path(os.getenv("CAMTRAP_DATA_DIR", str(ROOT / "data"))).resolve()
 
+# media rows per read/write batch in link_media_by_serial.py (bounds its memory)
+BATCH = 50_000
+
+# Cores this process may use (respects taskset/container limits on Linux)
+try:
+    NCPU = len(os.sched_getaffinity(0))
+except AttributeError:
+    NCPU = os.cpu_count() or 1
+
+# The steps parallelize across processes (exiftool workers, side-by-side
+# steps), so each child's BLAS/OpenMP/Arrow thread pool is held to one thread
+# instead of every child sizing its own pool to all cores. Values already
+# in the environment win.
+CHILD_ENV = dict(os.environ)
+for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    CHILD_ENV.setdefault(var, "1")
+# children write into a pipe (see relay_output): flush per line, always UTF-8
+CHILD_ENV.setdefault("PYTHONUNBUFFERED", "1")
+CHILD_ENV.setdefault("PYTHONIOENCODING", "utf-8")
+
+# exiftool processes for extract_exif.py, leaving a core for build_deployments
+# running next to it (extract_exif's own cap is 4)
+EXTRACT_WORKERS = max(1, min(4, NCPU - 1))
+
 # If I already set EXIFTOOL_PATH in my env, use it; otherwise let extract_exif.py discover it.
 EXIFTOOL = os.getenv("EXIFTOOL_PATH", "").strip()
 
-# If EXIFTOOL_PATH is a directory, assume the binary is inside it.
-# This makes it robust for folks who unzip exiftool and set the folder path.
-if EXIFTOOL:
-    p = Path(EXIFTOOL)
+@lru_cache(maxsize=None)
+def _exists(p: str) -> bool:
+    # each probe is a stat(), which can be slow on network/Defender-scanned drives
+    return os.path.exists(p)
+
+@lru_cache(maxsize=None)
+def _listing(folder: str) -> dict[str, bool]:
+    """name -> is_symlink for one folder, from a single scandir (one
+    round-trip on network drives; no per-entry stat)."""
+    try:
+        with os.scandir(folder) as it:
+            return {e.name: e.is_symlink() for e in it}
+    except OSError:
+        return {}
+
+def _listed(p: Path) -> bool:
+    # exists() through the parent folder's listing, so DATA and datapackage/
+    # (both usually in ROOT) cost one scandir; links and names not listed
+    # as-is (case-insensitive drives) fall back to a real stat
+    if _listing(str(p.parent)).get(p.name) is False:
+        return True
+    return _exists(str(p))
+
+# Where the resolved EXIFTOOL_PATH is remembered between runs
+EXIFTOOL_CACHE = Path.home() / ".cache" / "camtrapdp" / "exiftool.json"
+
+def _resolve_exiftool(path: str) -> str:
+    # If EXIFTOOL_PATH is a directory, assume the binary is inside it.
+    # This makes it robust for folks who unzip exiftool and set the folder path.
+    p = Path(path)
     if p.is_dir():
+        # one listing instead of a stat per candidate; lower-cased to match
+        # like exists() does on Windows
+        with os.scandir(p) as it:
+            names = {e.name.lower(): e.name for e in it}
         for name in ("exiftool.exe", "exiftool"):  # win + *nix
-            cand = p / name
-            if cand.exists():
-                EXIFTOOL = str(cand)
-                break  # stop at the first match
+            if name in names:
+                return str(p / names[name])  # stop at the first match
+    return path
+
+def _cached_exiftool(path: str) -> str:
+    """EXIFTOOL_PATH -> binary, trusting last run's answer while the binary's
+    mtime is unchanged (one stat instead of the folder probe)."""
+    try:
+        cache = json.loads(EXIFTOOL_CACHE.read_text(encoding="utf-8"))
+        if cache["source"] == path and os.stat(cache["path"]).st_mtime_ns == cache["mtime_ns"]:
+            return cache["path"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # no/stale/unreadable cache
+    resolved = _resolve_exiftool(path)
+    try:
+        entry = {"source": path, "path": resolved, "mtime_ns": os.stat(resolved).st_mtime_ns}
+        EXIFTOOL_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        EXIFTOOL_CACHE.write_text(json.dumps(entry), encoding="utf-8")
+    except OSError:
+        pass  # missing binary (preflight reports it) or read-only home
+    return resolved
+
+if EXIFTOOL:
+    EXIFTOOL = _cached_exiftool(EXIFTOOL)
 
 def die(msg: str, code: int = 1) -> None:
     print(f" {msg}")
     sys.exit(code)
 
-def run_or_die(cmd: list[str]) -> None:
-    # Always run from repo root so all relative paths behave
+async def relay_output(stream: asyncio.StreamReader, tag: str) -> None:
+    # one line at a time, prefixed with the step, so steps running side by
+    # side stay readable. A line longer than the stream limit is relayed in
+    # limit-sized pieces (readline would raise and drop it).
+    overrun = False
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            line = e.partial  # EOF: last line without a newline, or nothing
+            if not line:
+                break
+        except asyncio.LimitOverrunError as e:
+            line = await stream.read(e.consumed)
+            overrun = True
+        else:
+            if overrun and line == b"\n":
+                overrun = False
+                continue  # just the end of the piece already relayed
+            overrun = False
+        sys.stdout.write(f"[{tag}] {line.decode('utf-8', errors='replace').rstrip()}\n")
+        sys.stdout.flush()
+
+async def start_step(cmd: list[str]) -> tuple[asyncio.subprocess.Process, asyncio.Future]:
+    # Scripts are started by absolute path (they find the repo from __file__),
+    # so no cwd= is needed. Without cwd= and with close_fds=False, CPython
+    # launches them with posix_spawn instead of fork + closing every possible
+    # fd; nothing leaks, since Python opens files non-inheritable (PEP 446)
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, env=CHILD_ENV, close_fds=False,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        limit=1 << 20,  # longest line relayed (exiftool errors can be long)
+    )
+    return proc, asyncio.ensure_future(relay_output(proc.stdout, Path(cmd[1]).stem))
+
+async def wait_step(step: tuple[asyncio.subprocess.Process, asyncio.Future]) -> int:
+    proc, relay = step
+    await relay  # until the child's output is fully relayed
+    return await proc.wait()
+
+async def run_or_die(cmd: list[str]) -> None:
     print(f"\n>>> Running: {' '.join(cmd)}")
-    proc = subprocess.run(cmd, cwd=ROOT)
-    if proc.returncode != 0:
-        die(f"Failed: {' '.join(cmd)}", proc.returncode)
+    rc = await wait_step(await start_step(cmd))
+    if rc != 0:
+        die(f"Failed: {' '.join(cmd)}", rc)
+    print(" Done")
+
+async def run_all_or_die(cmds: list[list[str]]) -> None:
+    # Steps that don't depend on each other run side by side, all waited on
+    # from the one event loop. Each is checked as soon as it exits, so a
+    # failure stops the run right away (the other steps are terminated)
+    # instead of after the slowest step.
+    if not cmds:
+        return
+    for cmd in cmds:
+        print(f"\n>>> Running: {' '.join(cmd)}")
+    steps = [await start_step(cmd) for cmd in cmds]
+    waits = {asyncio.ensure_future(wait_step(step)): (cmd, step[0]) for cmd, step in zip(cmds, steps)}
+    pending = set(waits)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            cmd, _ = waits[task]
+            if task.result() != 0:
+                for other in pending:
+                    waits[other][1].terminate()
+                await asyncio.gather(*pending)
+                die(f"Failed: {' '.join(cmd)}", task.result())
     print(" Done")
 
 def preflight() -> None:
     print("=== Preflight ===")
     print(f"- Using Python      : {sys.executable}")
     print(f"- Repo root         : {ROOT}")
-    print(f"- Data dir          : {DATA} {'(exists)' if DATA.exists() else '(MISSING!)'}")
+    print(f"- Data dir          : {DATA} {'(exists)' if _listed(DATA) else '(MISSING!)'}")
     print(f"- datapackage dir   : {DP}")
+    print(f"- CPUs              : {NCPU} (extract_exif --workers {EXTRACT_WORKERS})")
 
     if EXIFTOOL:
         print(f"- EXIFTOOL_PATH     : {EXIFTOOL}")
-        if not Path(EXIFTOOL).exists():
+        if not _exists(EXIFTOOL):
             die(f"EXIFTOOL_PATH is set but not found: {EXIFTOOL}\n"
                 f"Hint: set EXIFTOOL_PATH to the *binary*, e.g. C:\\path\\to\\exiftool.exe")
     else:
@@ -56,51 +210,219 @@ def preflight() -> None:
 
     # I require the raw deployments sheet since build_deployments uses it
     raw_dep = DP / "raw_deployment.csv"
-    if not raw_dep.exists():
+    if not _listed(raw_dep):
         die(f"Missing input: {raw_dep}")
 
-    if not DATA.exists():
+    if not _listed(DATA):
         die(f"Missing data directory: {DATA}")
 
-def build_steps() -> list[list[str]]:
+MEDIA_EXTS = (".jpg", ".jpeg", ".png")  # what extract_exif.py picks up
+
+def _mtime(p: Path) -> float | None:
+    try:
+        return os.stat(p).st_mtime
+    except OSError:
+        return None
+
+# held for the whole run so two run_all.py can't write datapackage/ at once
+LOCK_FILE = DP / ".run_all.lock"
+
+# per-folder listings from the last scan, and the media list handed to extract_exif
+SCAN_CACHE  = DP / ".cache" / "media_dirs.json"
+MEDIA_LIST  = DP / ".cache" / "media_files.txt"
+
+def scan_media(root: Path) -> tuple[list[str], float]:
+    """
+    (media files under root in extract_exif's order, newest folder mtime).
+    Folders whose mtime is unchanged since the last run reuse their cached
+    listing, so an unchanged tree costs one stat per folder and no listing.
+    Folder mtimes change whenever images are added, removed or renamed;
+    an image replaced in place under the same name needs --force.
+    """
+    try:
+        cache = json.loads(SCAN_CACHE.read_text(encoding="utf-8"))
+        old = cache["dirs"] if cache.get("root") == str(root) else {}
+    except (OSError, ValueError, KeyError, AttributeError):
+        old = {}
+    dirs, files, newest = {}, [], 0.0
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            st = os.stat(d)
+        except OSError:
+            continue
+        newest = max(newest, st.st_mtime)
+        entry = old.get(d)
+        if entry is None or entry["mtime_ns"] != st.st_mtime_ns:
+            subdirs, names = [], []
+            try:
+                with os.scandir(d) as it:
+                    for e in it:
+                        # same rules as os.walk: symlinked folders are listed but not entered
+                        try:
+                            is_dir = e.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            if not e.is_symlink():
+                                subdirs.append(e.name)
+                        elif e.name.lower().endswith(MEDIA_EXTS):
+                            names.append(e.name)
+            except OSError:
+                continue  # unreadable folder: skipped (and not cached), as os.walk does
+            entry = {"mtime_ns": st.st_mtime_ns, "subdirs": subdirs, "files": names}
+        dirs[d] = entry
+        files.extend(os.path.join(d, n) for n in entry["files"])
+        stack.extend(os.path.join(d, n) for n in entry["subdirs"])
+    try:
+        SCAN_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        SCAN_CACHE.write_text(json.dumps({"root": str(root), "dirs": dirs}), encoding="utf-8")
+    except OSError:
+        pass  # cache is only a speed-up
+    files.sort(key=Path)  # iter_media's order
+    return files, newest
+
+def up_to_date(inputs: list[float | None], outputs: list[Path]) -> bool:
+    # Make-style: every output exists and is at least as new as every input
+    outs = [_mtime(p) for p in outputs]
+    if None in inputs or None in outs:
+        return False
+    return min(outs) >= max(inputs)
+
+def stale_steps(force: bool, data_mtime: float) -> set[str]:
+    """
+    Which of "deployments", "media" (extract + link) and "observations" need
+    to run. A step is stale when an output is missing or older than one of
+    its inputs (the step's scripts included), or when a step it depends on
+    is stale. --force makes everything stale.
+    """
+    if force:
+        return {"deployments", "media", "observations"}
+    stale = set()
+    if not up_to_date([_mtime(DP / "raw_deployment.csv"), _mtime(SCRIPTS / "build_deployments.py")],
+                      [DP / "deployments.csv"]):
+        stale.add("deployments")
+    # extract writes both media files; linking (into media.csv) also reads
+    # deployments.csv, which is built while extract runs. A media.csv linked
+    # against old deployments is stale too.
+    if ("deployments" in stale
+            or not up_to_date([data_mtime, _mtime(SCRIPTS / "extract_exif.py")],
+                              [DP / "media.csv", DP / "media_metadata.json"])
+            or not up_to_date([_mtime(DP / "deployments.csv"), _mtime(SCRIPTS / "link_media_by_serial.py")],
+                              [DP / "media.csv"])):
+        stale.add("media")
+    if "media" in stale or not up_to_date(
+            [_mtime(DP / "media.csv"), _mtime(SCRIPTS / "build_observations.py")],
+            [DP / "observations.csv", DP / "observations_to_label.csv"]):
+        stale.add("observations")
+    return stale
+
+def build_steps(stale: set[str]) -> tuple[list[list[str]], list[list[str]]]:
+    """(independent steps, steps that need their outputs), stale ones only"""
     # I explicitly pass --data-dir (and --exiftool when available)
+    # the media list comes from scan_media, so extract_exif doesn't walk DATA again
     extract_cmd = [
-        sys.executable, "scripts/extract_exif.py",
+        sys.executable, str(SCRIPTS / "extract_exif.py"),
         "--data-dir", str(DATA),
-        "--recursive",
-        "--embed-full-exif",
+        "--files-from", str(MEDIA_LIST),
         "--file-public", "false",
+        "--workers", str(EXTRACT_WORKERS),
     ]
     if EXIFTOOL:
         extract_cmd += ["--exiftool", EXIFTOOL]
 
-    return [
-        extract_cmd,
-        [sys.executable, "scripts/build_deployments.py"],
-        [sys.executable, "scripts/link_media_by_serial.py"],
-    ]
-
-def main() -> None:
-    preflight()
+    # extract_exif (media.csv) and build_deployments (deployments.csv) share
+    # nothing; linking reads both
+    independent, dependent = [], []
+    if "media" in stale:
+        independent.append(extract_cmd)
+        dependent.append([sys.executable, str(SCRIPTS / "link_media_by_serial.py"), "--batch-size", str(BATCH)])
+    if "deployments" in stale:
+        independent.append([sys.executable, str(SCRIPTS / "build_deployments.py")])
+    return independent, dependent
 
-    # First pass: extract → deployments → link
-    for cmd in build_steps():
-        run_or_die(cmd)
+def acquire_lock() -> int:
+    # exclusive and non-blocking: a second run stops right away instead of
+    # racing on media.csv. The OS drops the lock when this process exits; the
+    # fd is non-inheritable (PEP 446), so the steps don't hold it.
+    fd = os.open(LOCK_FILE, os.O_CREAT | os.O_RDWR)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        os.close(fd)
+        die(f"Another run_all.py is already running on {DP} (lock file: {LOCK_FILE})")
+    return fd
 
-    # After linking, I expect media_linked.csv to exist; copy over media.csv
+def move_linked_media() -> None:
+    # After linking, I expect media_linked.csv to exist; it replaces media.csv.
+    # Nothing reads media_linked.csv afterwards, so a rename does (no bytes copied)
     src = DP / "media_linked.csv"
     dst = DP / "media.csv"
     if not src.exists():
         die(f"Expected file not found: {src}")
-    copyfile(src, dst)
-    print(f"✅ Copied: {src} → {dst}")
+    os.replace(src, dst)  # same folder, so always a rename
+    print(f"✅ Moved: {src} → {dst}")
+
+def write_media_parquet(src: Path, dst: Path) -> None:
+    # every column as text, like the pipeline's own CSV readers (so e.g. an
+    # all-digit mediaID isn't turned into an integer)
+    with open(src, encoding="utf-8", newline="") as f:
+        header = next(csv.reader(f), [])
+    tbl = pac.read_csv(
+        src,
+        read_options=pac.ReadOptions(block_size=1 << 20),
+        parse_options=pac.ParseOptions(newlines_in_values=True),
+        convert_options=pac.ConvertOptions(column_types={c: pa.string() for c in header},
+                                           strings_can_be_null=False),
+    )
+    pq.write_table(tbl, dst, compression="zstd", row_group_size=BATCH)
+    print(f"✅ Wrote: {dst} ({tbl.num_rows} rows)")
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description="Run the whole Camtrap DP pipeline.")
+    ap.add_argument("--force", action="store_true",
+                    help="Re-run every step, even those whose outputs are newer than their inputs")
+    ap.add_argument("--parquet", action="store_true",
+                    help="Also write datapackage/media.parquet from media.csv (needs pyarrow)")
+    args = ap.parse_args()
+    if args.parquet and pa is None:
+        raise SystemExit("[ERROR] --parquet needs pyarrow: pip install pyarrow")
+
+    preflight()
+    _lock = acquire_lock()  # held until the process exits
+
+    media_files, data_mtime = scan_media(DATA)
+    stale = stale_steps(args.force, data_mtime)
+    for step in ("deployments", "media", "observations"):
+        if step not in stale:
+            print(f"- Up to date        : {step} (skipped; --force to rebuild)")
+
+    if "media" in stale:
+        MEDIA_LIST.parent.mkdir(parents=True, exist_ok=True)
+        MEDIA_LIST.write_text("".join(f + "\n" for f in media_files), encoding="utf-8")
+
+    # First pass: extract + deployments (in parallel) → link
+    independent, dependent = build_steps(stale)
+    await run_all_or_die(independent)
+    for cmd in dependent:
+        await run_or_die(cmd)
+
+    if "media" in stale:
+        move_linked_media()
+    if args.parquet and not up_to_date([_mtime(DP / "media.csv")], [DP / "media.parquet"]):
+        write_media_parquet(DP / "media.csv", DP / "media.parquet")
 
     # Build observations and emit a human-label template in one go
-    run_or_die([sys.executable, "scripts/build_observations.py", "--emit-label-template"])
+    if "observations" in stale:
+        await run_or_die([sys.executable, str(SCRIPTS / "build_observations.py"), "--emit-label-template"])
 
     print("\n All steps completed successfully!")
     print(" Annotate: datapackage/observations_to_label.csv")
     print(" Merge when ready: python scripts/merge_labels.py --inplace")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())